@@ -121,6 +121,18 @@ object as::
     }
 
 
+Working with NumPy data
+~~~~~~~~~~~~~~~~~~~~~~~
+
+With ``return_type=arff.NUMPY`` (requires numpy) the **data** key holds a
+tuple ``(columns, mask)`` instead of a list of instances. ``columns`` has one
+array per attribute: the index of the value in the declaration for nominal
+attributes, in the smallest integer type that holds it and -1 when missing,
+float64 for numeric attributes, NaN when missing, and an object array for
+strings. ``mask`` is a boolean array with a row per instance and a column per
+attribute marking the missing values. Nominal values are always encoded.
+
+
 Features
 ~~~~~~~~
 
@@ -150,6 +162,11 @@ import re
 import csv
 import sys
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # CONSTANTS ===================================================================
 _SIMPLE_TYPES = ['NUMERIC', 'REAL', 'INTEGER', 'STRING']
 
@@ -176,11 +193,14 @@ _ESCAPE_DCT = {
     '\\%': '\\%',
 }
 
+_BLOCK_LINES = 4096  # Data lines decoded together by the bulk dense path
+
 DENSE = 0   # Constant value representing a dense matrix
 COO = 1     # Constant value representing a sparse matrix in coordinate format
 LOD = 2     # Constant value representing a sparse matrix in list of
             # dictionaries format
-_SUPPORTED_DATA_STRUCTURES = [DENSE, COO, LOD]
+NUMPY = 3   # Constant value representing NumPy column arrays
+_SUPPORTED_DATA_STRUCTURES = [DENSE, COO, LOD, NUMPY]
 
 # =============================================================================
 
@@ -251,6 +271,14 @@ class BadObject(ArffException):
 # =============================================================================
 
 # INTERNAL ====================================================================
+def code_dtype(nvalues):
+    '''Returns the smallest signed integer type that holds the codes -1 to
+    ``nvalues`` - 1.'''
+    for dtype in (np.int8, np.int16, np.int32):
+        if nvalues <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
 def encode_string(s):
     def replace(match):
         return _ESCAPE_DCT[match.group(0)]
@@ -263,6 +291,9 @@ class Conversor(object):
         '''Contructor.'''
 
         self.values = values
+        self._type = type_
+        # converted values of nominal attributes by their raw text
+        self._cache = {}
 
         if type_ == 'NUMERIC' or type_ == 'REAL':
             self._conversor = self._float
@@ -272,6 +303,7 @@ class Conversor(object):
             self._conversor = self._integer
         elif type_ == 'NOMINAL':
             self._conversor = self._nominal
+            self._value_set = frozenset(values)
         elif type_ == 'ENCODED_NOMINAL':
             self._conversor = self._encoded_nominal
             self._encoded_values = dict((value, i) for (i, value) in enumerate(values))
@@ -298,7 +330,7 @@ class Conversor(object):
 
     def _nominal(self, value):
         '''Verify the value of nominal attribute and convert it to string.'''
-        if value not in self.values:
+        if value not in self._value_set:
             raise BadNominalValue()
 
         return self._string(value)
@@ -306,7 +338,7 @@ class Conversor(object):
     def _encoded_nominal(self, value):
         '''Perform label encoding (convert labels to integers) while reading
         the .arff file.'''
-        if value not in self.values:
+        if value not in self._encoded_values:
             raise BadNominalValue()
 
         return self._encoded_values[value]
@@ -324,6 +356,77 @@ class Conversor(object):
 
         return self._conversor(value)
 
+    def convert_all(self, values):
+        '''Convert a list of raw ``values`` at once.
+
+        The result is the same as calling the conversor on every value.
+        Nominal values are converted once per distinct raw text and then
+        looked up in a dictionary, numeric values are converted in bulk and
+        only fall back to the value by value path for missing or quoted
+        values.
+        '''
+        if self._type in ('NOMINAL', 'ENCODED_NOMINAL'):
+            cache = self._cache
+            for value in set(values).difference(cache):
+                cache[value] = self(value)
+            return [cache[value] for value in values]
+
+        if self._type in ('NUMERIC', 'REAL', 'INTEGER'):
+            try:
+                converted = list(map(float, values))
+            except ValueError:
+                return [self(value) for value in values]
+            if self._type == 'INTEGER':
+                converted = list(map(int, converted))
+            return converted
+
+        return [self(value) for value in values]
+
+    def to_array(self, values):
+        '''Convert a list of converted ``values`` to a NumPy array.
+
+        :return: a tuple (ARRAY, MASK), where MASK marks the missing values.
+            Nominal values become their index in the declaration, -1 when
+            missing, numeric values become float64, NaN when missing.
+        '''
+        mask = np.array([value is None for value in values], dtype=bool)
+        if self._type in ('NOMINAL', 'ENCODED_NOMINAL'):
+            array = np.array([-1 if value is None else value
+                              for value in values],
+                             dtype=code_dtype(len(self.values)))
+        elif self._type in ('NUMERIC', 'REAL', 'INTEGER'):
+            array = np.array([np.nan if value is None else value
+                              for value in values], dtype=np.float64)
+        else:
+            array = np.empty(len(values), dtype=object)
+            array[:] = values
+        return array, mask
+
+    def convert_array(self, values):
+        '''Convert a list of raw ``values`` straight to a NumPy array.
+
+        Only the distinct nominal values are converted one by one, numeric
+        values are parsed by NumPy unless a missing or quoted value is
+        present.
+
+        :return: a tuple (ARRAY, MASK) as returned by ``to_array``.
+        '''
+        if self._type in ('NOMINAL', 'ENCODED_NOMINAL'):
+            raw, inverse = np.unique(np.array(values), return_inverse=True)
+            array, mask = self.to_array(self.convert_all(raw.tolist()))
+            return array[inverse], mask[inverse]
+
+        if self._type in ('NUMERIC', 'REAL', 'INTEGER'):
+            try:
+                array = np.array(values).astype(np.float64)
+            except ValueError:
+                return self.to_array([self(value) for value in values])
+            if self._type == 'INTEGER':
+                array = np.trunc(array)
+            return array, np.zeros(len(values), dtype=bool)
+
+        return self.to_array([self(value) for value in values])
+
 class Data(object):
     '''Internal helper class to allow for different matrix types without
     making the code a huge collection of if statements.'''
@@ -347,6 +450,33 @@ class Data(object):
 
         self.data.append(values)
 
+    def decode_rows(self, rows, conversors):
+        '''Decodes a block of data lines, the same as ``decode_data`` on
+        every one of them.
+
+        Lines without quotes and in dense notation are split all at once and
+        converted column by column, other lines go through ``decode_data``.
+        '''
+        n = len(conversors)
+        plain = []
+        for s in rows:
+            if (n and '"' not in s and s.count(',') == n - 1 and
+                    s[:1] not in ('{', ',')):
+                plain.append(s)
+                continue
+            self._decode_plain(plain, conversors)
+            plain = []
+            self.decode_data(s, conversors)
+        self._decode_plain(plain, conversors)
+
+    def _decode_plain(self, rows, conversors):
+        if not rows:
+            return
+        n = len(conversors)
+        tokens = ','.join(rows).split(',')
+        columns = [conversors[i].convert_all(tokens[i::n]) for i in xrange(n)]
+        self.data.extend(list(values) for values in zip(*columns))
+
     def encode_data(self, data, attributes):
         '''(INTERNAL) Encodes a line of data.
 
@@ -375,6 +505,61 @@ class Data(object):
 
             yield u','.join(new_data)
 
+class NumpyData(Data):
+    '''Decodes the data into one NumPy array per attribute, see
+    ``Conversor.to_array``. ``data`` is the tuple (COLUMNS, MASK) where MASK
+    is a 2-D boolean array marking the missing values of every instance and
+    attribute.'''
+    def __init__(self, conversors):
+        self._conversors = conversors
+        self._columns = [[] for _ in conversors]
+        self._masks = [[] for _ in conversors]
+        # instances decoded line by line, waiting to become arrays
+        self._pending = Data()
+
+    def decode_data(self, s, conversors):
+        self._pending.decode_data(s, conversors)
+
+    def _decode_plain(self, rows, conversors):
+        if not rows:
+            return
+        self._flush()
+        n = len(conversors)
+        tokens = ','.join(rows).split(',')
+        for i in xrange(n):
+            array, mask = conversors[i].convert_array(tokens[i::n])
+            self._columns[i].append(array)
+            self._masks[i].append(mask)
+
+    def _flush(self):
+        rows = self._pending.data
+        if not rows:
+            return
+        for i, values in enumerate(zip(*rows)):
+            array, mask = self._conversors[i].to_array(list(values))
+            self._columns[i].append(array)
+            self._masks[i].append(mask)
+        self._pending = Data()
+
+    @property
+    def data(self):
+        self._flush()
+        columns = []
+        masks = []
+        for i, conversor in enumerate(self._conversors):
+            if self._columns[i]:
+                array = np.concatenate(self._columns[i])
+                mask = np.concatenate(self._masks[i])
+            else:
+                array, mask = conversor.to_array([])
+            self._columns[i] = [array]
+            self._masks[i] = [mask]
+            columns.append(array)
+            masks.append(mask)
+        if not masks:
+            return columns, np.zeros((0, 0), dtype=bool)
+        return columns, np.column_stack(masks)
+
 class COOData(Data):
     def __init__(self):
         self.data = ([], [], [])
@@ -481,16 +666,25 @@ class LODData(Data):
 
             yield " ".join([u"{", u','.join(new_data), u"}"])
 
-def _get_data_object_for_decoding(matrix_type):
+def _get_data_object_for_decoding(matrix_type, conversors=None):
     if matrix_type == DENSE:
         return Data()
     elif matrix_type == COO:
         return COOData()
     elif matrix_type == LOD:
         return LODData()
+    elif matrix_type == NUMPY:
+        if np is None:
+            raise ValueError("Matrix type NUMPY requires numpy.")
+        return NumpyData(conversors)
     else:
         raise ValueError("Matrix type %s not supported." % str(matrix_type))
 
+def _decodes_blocks(data):
+    '''Returns True for the data objects that decode dense lines in
+    blocks with ``decode_rows``.'''
+    return type(data) in (Data, NumpyData)
+
 def _get_data_object_for_encoding(matrix):
     # Probably a scipy.sparse
     if hasattr(matrix, 'format'):
@@ -610,27 +804,64 @@ class ArffDecoder(object):
     def _decode(self, s, encode_nominal=False, matrix_type=DENSE):
         '''Do the job the ``encode``.'''
 
+        # NumPy columns always hold the index of nominal values
+        if matrix_type == NUMPY:
+            encode_nominal = True
+
+        lines = self._lines(s)
+        obj = self._decode_header(lines, encode_nominal)
+
+        # Create the data helper object
+        data = _get_data_object_for_decoding(matrix_type, self._conversors)
+        if _decodes_blocks(data):
+            block = []
+            for row in self._data_rows(lines):
+                block.append((self._current_line, row))
+                if len(block) == _BLOCK_LINES:
+                    self._decode_block(data, block)
+                    block = []
+            self._decode_block(data, block)
+        else:
+            for row in self._data_rows(lines):
+                data.decode_data(row, self._conversors)
+
+        # Alter the data object
+        obj['data'] = data.data
+        return obj
+
+    def _lines(self, s):
+        '''(INTERNAL) Returns an iterator over the lines of ``s``, a string or
+        a file object.'''
+
         # Make sure this method is idempotent
         self._current_line = 0
+        self._conversors = []
 
         # If string, convert to a list of lines
         if isinstance(s, basestring):
             s = s.strip('\r\n ').replace('\r\n', '\n').split('\n')
 
+        return iter(s)
+
+    def _decode_header(self, lines, encode_nominal=False):
+        '''(INTERNAL) Decodes the lines up to and including the ``@DATA``
+        declaration.
+
+        :param lines: an iterator over the lines of the document, left at the
+            first line of the data section.
+        :return: a dictionary without the ``data`` key.
+        '''
+
         # Create the return object
         obj = {
             u'description': u'',
             u'relation': u'',
             u'attributes': [],
-            u'data': []
         }
 
-        # Create the data helper object
-        data = _get_data_object_for_decoding(matrix_type)
-
-        # Read all lines
+        # Read the lines of the header
         STATE = _TK_DESCRIPTION
-        for row in s:
+        for row in lines:
             self._current_line += 1
             # Ignore empty lines
             row = row.strip(' \r\n')
@@ -678,7 +909,7 @@ class ArffDecoder(object):
                 if STATE != _TK_ATTRIBUTE:
                     raise BadLayout()
 
-                STATE = _TK_DATA
+                break
             # -----------------------------------------------------------------
 
             # COMMENT ---------------------------------------------------------
@@ -686,23 +917,67 @@ class ArffDecoder(object):
                 pass
             # -----------------------------------------------------------------
 
-            # DATA INSTANCES --------------------------------------------------
-            elif STATE == _TK_DATA:
-                data.decode_data(row, self._conversors)
-            # -----------------------------------------------------------------
-
             # UNKNOWN INFORMATION ---------------------------------------------
             else:
                 raise BadLayout()
             # -----------------------------------------------------------------
 
-        # Alter the data object
-        obj['data'] = data.data
         if obj['description'].endswith('\n'):
             obj['description'] = obj['description'][:-1]
 
         return obj
 
+    def _decode_block(self, data, block):
+        '''(INTERNAL) Decodes a list of (LINE_NUMBER, LINE) pairs of dense
+        data with ``Data.decode_rows``. When the block holds an invalid line
+        it is decoded again line by line, so the exception reports the line
+        it comes from.'''
+        try:
+            data.decode_rows([row for _, row in block], self._conversors)
+        except ArffException:
+            # find the line the exception comes from
+            scratch = Data()
+            for line, row in block:
+                self._current_line = line
+                scratch.decode_data(row, self._conversors)
+            raise
+
+    def _decode_batch(self, data, block):
+        '''(INTERNAL) Decodes a list of (LINE_NUMBER, LINE) pairs into
+        ``data``, in blocks for dense data.'''
+        if _decodes_blocks(data):
+            for k in xrange(0, len(block), _BLOCK_LINES):
+                self._decode_block(data, block[k:k + _BLOCK_LINES])
+        else:
+            for line, row in block:
+                self._current_line = line
+                data.decode_data(row, self._conversors)
+
+    def _data_rows(self, lines):
+        '''(INTERNAL) Yields the data instance lines left in ``lines``,
+        stripped, skipping empty lines and comments.'''
+        for row in lines:
+            self._current_line += 1
+            # Ignore empty lines
+            row = row.strip(' \r\n')
+            if not row: continue
+
+            u_row = row.upper()
+
+            # COMMENT ---------------------------------------------------------
+            if u_row.startswith(_TK_COMMENT):
+                continue
+            # -----------------------------------------------------------------
+
+            # DECLARATIONS ARE NOT ALLOWED AFTER @DATA ------------------------
+            if (u_row.startswith(_TK_RELATION) or
+                    u_row.startswith(_TK_ATTRIBUTE) or
+                    u_row.startswith(_TK_DATA)):
+                raise BadLayout()
+            # -----------------------------------------------------------------
+
+            yield row
+
     def decode(self, s, encode_nominal=False, return_type=DENSE):
         '''Returns the Python representation of a given ARFF file.
 
@@ -713,8 +988,9 @@ class ArffDecoder(object):
         :param encode_nominal: boolean, if True perform a label encoding
             while reading the .arff file.
         :param return_type: determines the data structure used to store the
-            dataset. Can be one of `arff.DENSE`, `arff.COO` and `arff.LOD`.
-            Consult the section on `working with sparse data`_
+            dataset. Can be one of `arff.DENSE`, `arff.COO`, `arff.LOD` and
+            `arff.NUMPY`. Consult the section on `working with sparse data`_
+            and `working with numpy data`_
         '''
 
         try:
@@ -725,6 +1001,70 @@ class ArffDecoder(object):
             e.line = self._current_line
             raise e
 
+    def iter_decode(self, s, encode_nominal=False, return_type=DENSE,
+                    batch_size=None):
+        '''Returns the header of a given ARFF file and a generator over its
+        data.
+
+        The header is decoded right away, the data section is only read as
+        the generator is consumed, so a file object is never held in memory
+        as a whole.
+
+        :param s: a string or file object with the ARFF file.
+        :param encode_nominal: boolean, if True perform a label encoding
+            while reading the .arff file.
+        :param return_type: determines the data structure used to store the
+            dataset. Can be one of `arff.DENSE`, `arff.COO`, `arff.LOD` and
+            `arff.NUMPY`.
+        :param batch_size: if None, the generator yields one instance at a
+            time, otherwise it yields the data of up to ``batch_size``
+            instances in the structure of ``return_type``. The row indices of
+            a COO batch start at 0 for every batch.
+        :return: a tuple (HEADER, GENERATOR) where HEADER is the dictionary
+            of ``decode`` without the ``data`` key.
+        '''
+        if batch_size is None and return_type in (COO, NUMPY):
+            raise ValueError('COO and NUMPY data can only be read in batches.')
+        if return_type == NUMPY:
+            encode_nominal = True
+        if batch_size is not None and batch_size < 1:
+            raise ValueError('batch_size must be at least 1.')
+
+        lines = self._lines(s)
+        try:
+            obj = self._decode_header(lines, encode_nominal)
+        except ArffException as e:
+            e.line = self._current_line
+            raise e
+
+        def generator():
+            data = _get_data_object_for_decoding(return_type, self._conversors)
+            block = []
+            try:
+                for row in self._data_rows(lines):
+                    if batch_size is None:
+                        data.decode_data(row, self._conversors)
+                        for instance in data.data:
+                            yield instance
+                        del data.data[:]
+                        continue
+
+                    block.append((self._current_line, row))
+                    if len(block) == batch_size:
+                        self._decode_batch(data, block)
+                        yield data.data
+                        data = _get_data_object_for_decoding(return_type,
+                                                             self._conversors)
+                        block = []
+                if block:
+                    self._decode_batch(data, block)
+                    yield data.data
+            except ArffException as e:
+                e.line = self._current_line
+                raise e
+
+        return obj, generator()
+
 
 class ArffEncoder(object):
     '''An ARFF encoder.'''
@@ -870,14 +1210,34 @@ def load(fp, encode_nominal=False, return_type=DENSE):
     :param encode_nominal: boolean, if True perform a label encoding
         while reading the .arff file.
     :param return_type: determines the data structure used to store the
-        dataset. Can be one of `arff.DENSE`, `arff.COO` and `arff.LOD`.
-        Consult the section on `working with sparse data`_
+        dataset. Can be one of `arff.DENSE`, `arff.COO`, `arff.LOD` and
+        `arff.NUMPY`. Consult the section on `working with sparse data`_
+        and `working with numpy data`_
     :return: a dictionary.
      '''
     decoder = ArffDecoder()
     return decoder.decode(fp, encode_nominal=encode_nominal,
                           return_type=return_type)
 
+def iter_load(fp, encode_nominal=False, return_type=DENSE, batch_size=None):
+    '''Load the header of a file-like object containing the ARFF document and
+    iterate lazily over its data.
+
+    :param fp: a file-like object.
+    :param encode_nominal: boolean, if True perform a label encoding
+        while reading the .arff file.
+    :param return_type: determines the data structure used to store the
+        dataset. Can be one of `arff.DENSE`, `arff.COO`, `arff.LOD` and
+        `arff.NUMPY`.
+    :param batch_size: number of instances per item of the generator, None
+        to yield the instances one by one.
+    :return: a tuple (HEADER, GENERATOR), HEADER is the dictionary of ``load``
+        without the ``data`` key.
+    '''
+    decoder = ArffDecoder()
+    return decoder.iter_decode(fp, encode_nominal=encode_nominal,
+                               return_type=return_type, batch_size=batch_size)
+
 def loads(s, encode_nominal=False, return_type=DENSE):
     '''Convert a string instance containing the ARFF document into a Python
     object.
@@ -886,8 +1246,9 @@ def loads(s, encode_nominal=False, return_type=DENSE):
     :param encode_nominal: boolean, if True perform a label encoding
         while reading the .arff file.
     :param return_type: determines the data structure used to store the
-        dataset. Can be one of `arff.DENSE`, `arff.COO` and `arff.LOD`.
-        Consult the section on `working with sparse data`_
+        dataset. Can be one of `arff.DENSE`, `arff.COO`, `arff.LOD` and
+        `arff.NUMPY`. Consult the section on `working with sparse data`_
+        and `working with numpy data`_
     :return: a dictionary.
     '''
     decoder = ArffDecoder()
@@ -3,11 +3,11 @@ from tan import Tan
 import sys
 
 def tan(trainf, testf):
-    t = Tan(trainf)
+    t = Tan(trainf, cache = True)
     t.classify(testf)
 
 def naivebayes(trainf, testf):
-    nb = NaiveBayes(trainf)
+    nb = NaiveBayes(trainf, cache = True)
     nb.classify(testf)
 
 if __name__ == '__main__':
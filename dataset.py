@@ -0,0 +1,259 @@
+import hashlib
+import os
+import numpy as np
+import modelfile
+from arff import code_dtype
+
+# suffix of the sidecar file that caches the decoded columns of a file
+SIDECAR = '.columns'
+
+def file_digest(path):
+    """
+    :return: SHA-1 hex digest of the content of path
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def is_nominal(attr):
+    return isinstance(attr[1], (list, tuple))
+
+def is_numeric(attr):
+    return attr[1] in ('NUMERIC', 'REAL', 'INTEGER')
+
+def column_dtype(attr):
+    """
+    :return: dtype of the column that holds attribute attr
+    """
+    if is_nominal(attr):
+        return code_dtype(len(attr[1]))
+    if is_numeric(attr):
+        return np.float64
+    return object
+
+def row_columns(rows):
+    """
+    :return: the columns of rows, a Dataset or a 2-D array as taken by
+        predict_proba
+    """
+    if isinstance(rows, Dataset):
+        return rows.columns
+    rows = np.asarray(rows)
+    return [rows[:, i] for i in range(rows.shape[1])]
+
+class Dataset(object):
+    """Columnar, integer coded dataset
+
+    Every nominal attribute is stored as one array with the index of the
+    value in the nominal declaration, -1 for a missing value. Numeric
+    attributes are stored as float64 arrays with NaN for a missing value.
+    STRING attributes are kept as object arrays of the values themselves,
+    None for a missing value.
+    Subsets share nothing with per row Python objects, so training and
+    scoring never materialize one dictionary or list per instance.
+    """
+    def __init__(self, attributes, columns):
+        self.attributes = attributes
+        self.columns = columns
+
+    @classmethod
+    def empty(cls, attributes):
+        columns = list()
+        for attr in attributes:
+            columns.append(np.zeros(0, dtype=column_dtype(attr)))
+        return cls(attributes, columns)
+
+    @classmethod
+    def from_arff(cls, obj):
+        """
+        :param obj: dictionary returned by arff.load with encode_nominal=True
+        :return: the dataset holding obj['data']
+        """
+        attributes = obj['attributes']
+        data = np.array(obj['data'], dtype=object).reshape(-1, len(attributes))
+        columns = list()
+        for i, attr in enumerate(attributes):
+            column = data[:, i]
+            if is_nominal(attr):
+                column = column.astype(np.float64)
+                column = np.where(np.isnan(column), -1, column).astype(column_dtype(attr))
+            elif is_numeric(attr):
+                column = column.astype(np.float64)
+            else:
+                column = column.copy()
+            columns.append(column)
+        return cls(attributes, columns)
+
+    @classmethod
+    def from_columns(cls, obj):
+        """
+        :param obj: dictionary returned by arff.load with
+            return_type=arff.NUMPY
+        :return: the dataset holding the decoded columns, without a copy
+        """
+        return cls(obj['attributes'], obj['data'][0])
+
+    @classmethod
+    def from_rows(cls, attributes, rows):
+        """
+        :param attributes: attribute declarations as returned by arff.load
+        :param rows: list of instances with the values themselves, as
+            returned by arff.load without encode_nominal
+        :return: the dataset holding rows
+        :raises ValueError: for a nominal value that is not declared
+        """
+        indexes = [dict((v, j) for j, v in enumerate(attr[1])) if is_nominal(attr) else None
+                   for attr in attributes]
+        encoded = list()
+        for rd in rows:
+            row = list()
+            for attr, index, v in zip(attributes, indexes, rd):
+                if index is not None and v is not None:
+                    if v not in index:
+                        raise ValueError('%r is not declared for the nominal attribute %s' % (v, attr[0]))
+                    v = index[v]
+                row.append(v)
+            encoded.append(row)
+        return cls.from_arff({'attributes': attributes, 'data': encoded})
+
+    @classmethod
+    def load(cls, fp):
+        """
+        :param fp: a file-like object with an ARFF document
+        """
+        arff = __import__("arff")
+        return cls.from_columns(arff.load(fp, return_type=arff.NUMPY))
+
+    @classmethod
+    def read(cls, path, processes = 1, cache = False):
+        """
+        :param path: Name of an ARFF file
+        :param processes: Number of worker processes that decode parts of
+            the data section, None for one per core and 1 to decode it in
+            the calling process
+        :param cache: Keep the decoded columns in a sidecar file next to
+            path and map that file on later reads of the same content
+            instead of parsing it again
+        """
+        if cache:
+            data = cls.read_sidecar(path)
+            if data is not None:
+                return data
+
+        st = os.stat(path)
+        if processes == 1:
+            with open(path) as f:
+                data = cls.load(f)
+        else:
+            parallel = __import__("parallel")
+            data = cls.from_columns(parallel.load_arff(path, processes))
+
+        if cache:
+            data.write_sidecar(path, st)
+        return data
+
+    @classmethod
+    def read_sidecar(cls, path):
+        """
+        :return: the dataset cached for path, its columns are read only
+            views into the memory mapped sidecar file. None when there is no
+            sidecar or it was written for other content: a file of another
+            size or, when the modification time changed, another digest.
+        """
+        sidecar = path + SIDECAR
+        if not os.path.exists(sidecar):
+            return None
+        try:
+            header, arrays = modelfile.read(sidecar)
+        except (IOError, ValueError):
+            return None
+        st = os.stat(path)
+        if header.get('model') != 'dataset' or header['size'] != st.st_size:
+            return None
+
+        attributes = [tuple(attr) for attr in header['attributes']]
+        data = cls(attributes, [arrays['column%d' % i] for i in range(len(attributes))])
+        if header['mtime'] != st.st_mtime:
+            if header['sha1'] != file_digest(path):
+                return None
+            # same content under a new modification time, remember it
+            data.write_sidecar(path, st, header['sha1'])
+        return data
+
+    def write_sidecar(self, path, st, digest = None):
+        """
+        Caches the columns for path, see modelfile for the format. Nothing
+        is written for columns without a fixed size type or when path
+        changed since st was taken, errors writing the file are ignored.
+
+        :param st: os.stat of path before it was decoded
+        """
+        if any(column.dtype == object for column in self.columns):
+            return
+        if digest is None:
+            digest = file_digest(path)
+        now = os.stat(path)
+        if (now.st_size, now.st_mtime) != (st.st_size, st.st_mtime):
+            return
+
+        sidecar = path + SIDECAR
+        header = {'model': 'dataset', 'source': os.path.abspath(path), 'size': st.st_size,
+                  'mtime': st.st_mtime, 'sha1': digest, 'attributes': self.attributes}
+        arrays = [('column%d' % i, column) for i, column in enumerate(self.columns)]
+        # write next to the final name and rename, readers never see a
+        # partial file
+        tmp = '%s.%d' % (sidecar, os.getpid())
+        try:
+            modelfile.write(tmp, header, arrays)
+            os.rename(tmp, sidecar)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @classmethod
+    def iter_load(cls, fp, batch_size = 10000):
+        """
+        :param fp: a file-like object with an ARFF document
+        :param batch_size: Number of instances per dataset
+        :return: (generator) a dataset for every batch_size instances, the
+            data section is only read as the batches are consumed
+        """
+        arff = __import__("arff")
+        header, batches = arff.iter_load(fp, return_type=arff.NUMPY, batch_size=batch_size)
+        for data in batches:
+            yield cls.from_columns({'attributes': header['attributes'], 'data': data})
+
+    def __len__(self):
+        if len(self.columns) == 0:
+            return 0
+        return len(self.columns[0])
+
+    def take(self, index):
+        """
+        :param index: sequence of row numbers
+        :return: a new dataset with the selected rows, in that order
+        """
+        index = np.asarray(index, dtype=np.intp)
+        return Dataset(self.attributes, [column[index] for column in self.columns])
+
+    def codes(self):
+        """
+        :return: 2-D array with one row per instance and one column per
+            attribute, as taken by predict_proba. The array is integer for
+            nominal only data, with numeric attributes it is float64 and the
+            numeric values and their NaN are kept as they are.
+        """
+        dtype = np.intp if all(is_nominal(attr) for attr in self.attributes) else np.float64
+        return np.column_stack([column.astype(dtype) for column in self.columns]).reshape(
+            len(self), len(self.columns))
+
+    def value(self, i, code):
+        """
+        :return: the value of nominal attribute i with the given code, None
+            when it is missing
+        """
+        if code < 0:
+            return None
+        return self.attributes[i][1][code]
@@ -7,12 +7,12 @@ import sys
 
 def evaluate_tan():
     t = Tan(sys.argv[1], evaluate = True)
-    out = t.evaluate(sys.argv[2])
+    out = t.evaluate(sys.argv[2], processes = None)
     process(out, 'TAN')
 
 def evaluate_naivebayes():
     nb = NaiveBayes(sys.argv[1], evaluate = True)
-    out = nb.evaluate(sys.argv[2])
+    out = nb.evaluate(sys.argv[2], processes = None)
     process(out, 'Naive Bayes')
 
 def process(out, classifier):
@@ -0,0 +1,74 @@
+"""
+Binary file format for trained models and cached datasets.
+
+The file starts with a fixed preamble (magic string, format version and
+the length of the header), followed by a JSON header and the raw bytes
+of every array. Arrays are aligned to 8 bytes so read() can hand out
+views straight into a read only memory map, processes that load the same
+model file share its pages instead of holding private copies.
+"""
+
+import json
+import mmap
+import struct
+import numpy as np
+
+MAGIC = b'BAYESMDL'
+VERSION = 1
+_PREAMBLE = struct.Struct('<8sIQ')
+_ALIGN = 8
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def write(path, header, arrays):
+    """
+    :param path: Name of the model file
+    :param header: JSON serializable dictionary with the model metadata
+    :param arrays: list of (name, numpy array) pairs
+    """
+    layout = list()
+    offset = 0
+    arrays = [(name, np.ascontiguousarray(a)) for name, a in arrays]
+    for name, a in arrays:
+        layout.append([name, a.dtype.newbyteorder('<').str, list(a.shape), offset])
+        offset = _aligned(offset + a.nbytes)
+
+    header = dict(header)
+    header['arrays'] = layout
+    encoded = json.dumps(header).encode('utf-8')
+    start = _aligned(_PREAMBLE.size + len(encoded))
+
+    with open(path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(encoded)))
+        f.write(encoded)
+        for (name, a), (_, dtype, _, offset) in zip(arrays, layout):
+            f.write(b'\0' * (start + offset - f.tell()))
+            f.write(a.astype(dtype, copy=False).tobytes())
+
+def read(path):
+    """
+    :param path: Name of the model file
+    :return: (header, arrays) where arrays maps every array name to a read
+        only view into the memory mapped file
+    """
+    with open(path, 'rb') as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ValueError('%s is not a model file' % path)
+        magic, version, length = _PREAMBLE.unpack(preamble)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a model file' % path)
+        header = json.loads(f.read(length).decode('utf-8'))
+        start = _aligned(_PREAMBLE.size + length)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    arrays = dict()
+    for name, dtype, shape, offset in header.pop('arrays'):
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        if count == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+            continue
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=start + offset).reshape(shape)
+    return header, arrays
@@ -1,57 +1,242 @@
 from __future__ import division
-import copy
+import multiprocessing
+import os
 import sys
-import operator
 import random
+import numpy as np
+import modelfile
+import parallel
+from dataset import Dataset, is_nominal, is_numeric, row_columns
 
-class NaiveBayes:
+def class_moments(values, classes, nclasses):
+    """
+    :param values: float array with NaN for missing values
+    :param classes: class index of every value
+    :return: array with rows count, mean and sum of squared deviations from
+        the mean of the non missing values in every class
+    """
+    present = ~np.isnan(values)
+    values, classes = values[present], classes[present]
+    n = np.bincount(classes, minlength=nclasses).astype(np.float64)
+    mean = np.bincount(classes, weights=values, minlength=nclasses) / np.maximum(n, 1)
+    m2 = np.bincount(classes, weights=(values - mean[classes]) ** 2, minlength=nclasses)
+    return np.array([n, mean, m2])
+
+def merge_moments(a, b):
+    """
+    :return: the class_moments of the union of the values behind a and b
+    """
+    n = a[0] + b[0]
+    fraction = b[0] / np.maximum(n, 1)
+    delta = b[1] - a[1]
+    return np.array([n, a[1] + delta * fraction, a[2] + b[2] + delta ** 2 * a[0] * fraction])
+
+class NaiveBayes(object):
     """This is the Naive Bayes classifier
 
     The constructor takes name if the training file as the argument.
-    This class does lazy evaluation, so only training data is loaded
-    and no calculations are done. Calculation is done for each entry
-    in test data.
+    The data is kept as a columnar Dataset of nominal codes, training
+    makes a single pass over the data and keeps only the class and
+    attribute|class count tables, every probability is then a constant
+    time lookup into those tables.
+
+    NUMERIC, REAL and INTEGER attributes are modelled with a Gaussian per
+    class, from the running count, mean and squared deviation of the
+    values in that class. The moments of two batches merge exactly, so
+    they can be updated incrementally and counted in shards.
 
     Classification begins with the call to classify() method with
     the test arff file as the input argument.
     """
-    def __init__(self, fname, evaluate = False):
+    # added to every variance, scaled by the largest variance of the attribute
+    var_smoothing = 1e-9
+
+    def __init__(self, fname, evaluate = False, processes = 1, cache = False):
+        """
+        :param fname: Name of the training file
+        :param evaluate: Only load the data, evaluate() trains the models
+        :param processes: Number of worker processes used to decode the
+            training file, None for one per core
+        :param cache: Keep the decoded training and test files in sidecar
+            files, see Dataset.read
+        """
         self.arff = __import__("arff")
-        self.data = None
-        self.raw_test_data = None
-        self.test_data = None
-        self.attribute_dictionary = dict()
-        with open(fname) as f:
-            self.eval_data = self.arff.load(f)
-        self.make_attribute_dictionary()
+        self.setup(Dataset.read(fname, processes, cache))
+        self.cache = cache
 
         if not evaluate:
-            self.raw_data = copy.deepcopy(self.eval_data)
+            self.raw_data = self.eval_data
             self.generate_model()
 
+    def setup(self, eval_data):
+        self.total = 0
+        self.class_counts = None
+        self.counts = None
+        self.moments = None
+        self.log_tables = None
+        self.test_data = None
+        self.test_cache = None
+        self.cache = False
+        self.attribute_dictionary = dict()
+        self.attribute_no_lookup = dict()
+        self.value_index = dict()
+        self.eval_data = eval_data
+        if not is_nominal(eval_data.attributes[-1]):
+            raise ValueError('The class attribute %s is not nominal' % eval_data.attributes[-1][0])
+        for attr in eval_data.attributes[:-1]:
+            if not is_nominal(attr) and not is_numeric(attr):
+                raise ValueError('NaiveBayes needs nominal or numeric attributes, %s is %s' % attr)
+        self.make_attribute_dictionary()
+
     def generate_model(self):
-        self.data = copy.deepcopy(self.process_raw_data(self.raw_data['data']))
+        self.reset_counts()
+        self.update_counts(self.raw_data)
 
     def clean_training_data(self):
-        self.data = None
-        self.raw_test_data = None
+        self.reset_counts()
         self.test_data = None
 
+    def reset_counts(self):
+        self.log_tables = None
+        self.total = 0
+        nclasses = len(self.eval_data.attributes[-1][1]) + 1
+        self.class_counts = np.zeros(nclasses, dtype=np.int64)
+        self.counts = list()
+        self.moments = list()
+        for attr in self.eval_data.attributes[:-1]:
+            if is_nominal(attr):
+                self.counts.append(np.zeros((len(attr[1]) + 1, nclasses), dtype=np.int64))
+                self.moments.append(None)
+            else:
+                self.counts.append(None)
+                self.moments.append(np.zeros((3, nclasses)))
+
+    def update_counts(self, data):
+        """
+        Adds the rows of the Dataset data to the count tables in a single pass.
+        """
+        self.add_statistics(self.sufficient_statistics(data))
+
+    def sufficient_statistics(self, data):
+        """
+        :param data: Dataset with the instances to count
+        :return: (total, class_counts, counts, moments)
+            class_counts[c] is the number of rows in class c and counts[i][v, c]
+            the number of those rows that also have nominal attribute i set
+            to v. Values and classes are indexed by their position in the
+            nominal declaration, the extra last index counts rows where the
+            value is missing. moments[i] holds the class_moments of numeric
+            attribute i. Entries that do not apply to an attribute are None.
+        """
+        nclasses = len(self.eval_data.attributes[-1][1]) + 1
+        classes = data.columns[-1].astype(np.intp) % nclasses
+
+        class_counts = np.bincount(classes, minlength=nclasses)
+        counts = list()
+        moments = list()
+        for i, attr in enumerate(self.eval_data.attributes[:-1]):
+            if is_nominal(attr):
+                nvalues = len(attr[1]) + 1
+                cells = data.columns[i].astype(np.intp) % nvalues * nclasses + classes
+                counts.append(np.bincount(cells, minlength=nvalues * nclasses).reshape(nvalues, nclasses))
+                moments.append(None)
+            else:
+                counts.append(None)
+                moments.append(class_moments(data.columns[i], classes, nclasses))
+        return len(data), class_counts, counts, moments
+
+    def add_statistics(self, stats):
+        """
+        Merges the result of sufficient_statistics into the count tables in
+        place.
+        """
+        total, class_counts, counts, moments = stats
+        self.log_tables = None
+        self.make_writable()
+        self.total += total
+        self.class_counts += class_counts
+        for a, b in zip(self.counts, counts):
+            if a is not None:
+                a += b
+        for a, b in zip(self.moments, moments):
+            if a is not None:
+                a[:] = merge_moments(a, b)
+
+    def add_rows(self, data):
+        """
+        Counts the instances of data into the count tables in place. Unlike
+        add_statistics no count tables are built for the rows and the log
+        tables are kept, only the estimates the rows change are worked out
+        again, see update_log_tables.
+        """
+        nclasses = len(self.class_counts)
+        classes = data.columns[-1].astype(np.intp) % nclasses
+        self.make_writable()
+        self.total += len(data)
+        np.add.at(self.class_counts, classes, 1)
+        for i, (counts, moments) in enumerate(zip(self.counts, self.moments)):
+            if counts is None:
+                moments[:] = merge_moments(moments, class_moments(data.columns[i], classes, nclasses))
+            else:
+                np.add.at(counts, (data.columns[i].astype(np.intp) % counts.shape[0], classes), 1)
+        if self.log_tables is not None:
+            self.update_log_tables(np.unique(classes[classes < nclasses - 1]))
+
+    def update_log_tables(self, classes):
+        """
+        Brings the log tables up to date after the counts of classes
+        changed. The log prior and, in the table of every nominal
+        attribute, the columns of classes are worked out again.
+
+        :param classes: array with the index of every changed class
+        """
+        log_prior, log_conditionals = self.log_tables
+        class_counts = self.class_counts[:-1]
+        log_prior[:] = np.log((class_counts + 1) / (self.total + len(class_counts)))
+        for counts, table in zip(self.counts, log_conditionals):
+            if counts is None:
+                continue
+            for c in classes:
+                np.log((counts[:, c] + 1) / (class_counts[c] + counts.shape[0] - 1), out=table[:, c])
+
+    def make_writable(self):
+        """
+        Copies the count and log tables when they are read only views into
+        the file mapped by load(), before they are updated in place.
+        """
+        if not self.class_counts.flags.writeable:
+            self.class_counts = self.class_counts.copy()
+            self.counts = [None if a is None else a.copy() for a in self.counts]
+            self.moments = [None if a is None else a.copy() for a in self.moments]
+        if self.log_tables is not None and not self.log_tables[0].flags.writeable:
+            log_prior, log_conditionals = self.log_tables
+            self.log_tables = (log_prior.copy(), [None if a is None else a.copy() for a in log_conditionals])
+
     def make_attribute_dictionary(self):
-        for attr in self.eval_data['attributes']:
+        i = 0
+        for attr in self.eval_data.attributes:
             self.attribute_dictionary[attr[0]] = attr[1]
+            self.attribute_no_lookup[attr[0]] = i
+            if is_nominal(attr):
+                self.value_index[attr[0]] = dict((v, j) for j, v in enumerate(attr[1]))
+            i += 1
 
-    def process_raw_data(self, raw_data):
-        res = list()
-        for rd in raw_data:
-            di = dict()
-            i = 0
-            for key in self.raw_data['attributes']:
-                di[key[0]] = rd[i]
-                i += 1
+    def gaussian_log_likelihood(self, i, values):
+        """
+        :param i: Index of a numeric attribute
+        :param values: float array, NaN for missing values
+        :return: array with log N(value; mean, variance) of every value for
+            every class, 0 for missing values and classes without any value
+        """
+        n, mean, m2 = self.moments[i][:, :-1]
+        var = m2 / np.maximum(n, 1)
+        var = var + self.var_smoothing * max(var.max(), 1.0)
 
-            res.append(di)
-        return res
+        values = np.asarray(values, dtype=np.float64)[:, np.newaxis]
+        loglik = -0.5 * np.log(2 * np.pi * var) - (values - mean) ** 2 / (2 * var)
+        loglik[:, n == 0] = 0
+        loglik[np.isnan(values[:, 0])] = 0
+        return loglik
 
     def conditional_probability(self, fname, fval, classifierval, classifier = 'class', laplace = True):
         """
@@ -63,8 +248,16 @@ class NaiveBayes:
         :return: Conditional Probability
             P(fname = fval | classifier = classifierval)
         """
-        total = len([1 for d in self.data if d[classifier] == classifierval])
-        conditional_count = len([1 for d in self.data if d[classifier] == classifierval and d[fname] == fval])
+        c = self.value_index[classifier].get(classifierval, -1)
+        i = self.attribute_no_lookup[fname]
+        if self.moments[i] is not None:
+            # density of the class Gaussian, the laplace estimate does not apply
+            value = np.nan if fval is None else fval
+            return float(np.exp(self.gaussian_log_likelihood(i, [value])[0, c]))
+
+        v = self.value_index[fname].get(fval, -1)
+        total = int(self.class_counts[c])
+        conditional_count = int(self.counts[self.attribute_no_lookup[fname]][v, c])
 
         if laplace:
             conditional_count += 1
@@ -80,8 +273,12 @@ class NaiveBayes:
         :return: Probability
             P(fname = fval)
         """
-        total = len(self.data)
-        count = sum(1 for d in self.data if d[fname] == fval)
+        v = self.value_index[fname].get(fval, -1)
+        total = self.total
+        if fname == self.eval_data.attributes[-1][0]:
+            count = int(self.class_counts[v])
+        else:
+            count = int(self.counts[self.attribute_no_lookup[fname]][v].sum())
 
         if laplace:
             total += len(self.attribute_dictionary[fname])
@@ -89,64 +286,222 @@ class NaiveBayes:
 
         return count / total
 
+    def partial_fit(self, rows):
+        """
+        Adds new training instances to the model without retraining, the
+        rows are counted in place by add_rows. The cost is proportional to
+        the number of new rows and, for the log tables, to the values of the
+        classes they hold. raw_data keeps the data of the last full training.
+
+        :param rows: Dataset or list of instances, each a list of values in
+            attribute order as returned by arff.load
+        """
+        if not isinstance(rows, Dataset):
+            rows = Dataset.from_rows(self.eval_data.attributes, rows)
+        self.add_rows(rows)
+
+    def log_probability_tables(self):
+        """
+        :return: (log_prior, log_conditionals)
+            log_prior[c] = log P(class = c) and
+            log_conditionals[i][v, c] = log P(attribute i = v | class = c)
+            Values are indexed by their position in the nominal declaration
+            and the extra last row holds the estimate for a missing value.
+            Numeric attributes have no table, their entry is None.
+        """
+        if self.log_tables is None:
+            class_counts = self.class_counts[:-1]
+            log_prior = np.log((class_counts + 1) / (self.total + len(class_counts)))
+
+            log_conditionals = list()
+            for counts in self.counts:
+                if counts is None:
+                    log_conditionals.append(None)
+                else:
+                    log_conditionals.append(np.log((counts[:, :-1] + 1) / (class_counts + counts.shape[0] - 1)))
+            self.log_tables = (log_prior, log_conditionals)
+        return self.log_tables
+
+    def predict_proba(self, rows):
+        """
+        :param rows: Dataset or 2-D array of integer coded instances, one
+            column per attribute in declaration order, the class column may
+            be left out. Missing nominal values are coded as -1, numeric
+            attributes hold the value itself and NaN when it is missing.
+        :return: array with P(class = c | row) for every row and class c
+        """
+        log_prior, log_conditionals = self.log_probability_tables()
+        columns = row_columns(rows)
+
+        log_posterior = np.tile(log_prior, (len(columns[0]), 1))
+        for i, table in enumerate(log_conditionals):
+            if table is None:
+                log_posterior += self.gaussian_log_likelihood(i, columns[i])
+            else:
+                log_posterior += table[columns[i].astype(np.intp)]
+
+        log_posterior -= log_posterior.max(axis=1)[:, np.newaxis]
+        posterior = np.exp(log_posterior)
+        return posterior / posterior.sum(axis=1)[:, np.newaxis]
+
+    def predict(self, rows):
+        """
+        :param rows: Dataset or 2-D array of coded instances, see predict_proba
+        :return: array with the index of the most probable class for every row
+        """
+        return self.predict_proba(rows).argmax(axis=1)
+
+    @classmethod
+    def empty(cls, attributes):
+        """
+        :param attributes: attribute declarations as returned by arff.load
+        :return: an untrained model without any training data
+        """
+        nb = cls.__new__(cls)
+        nb.arff = __import__("arff")
+        nb.setup(Dataset.empty(attributes))
+        nb.raw_data = nb.eval_data
+        nb.reset_counts()
+        return nb
+
+    @classmethod
+    def train_sharded(cls, paths, shards = None, processes = None):
+        """
+        Trains on the data sections of one or more ARFF files without loading
+        them. Every file is split into line aligned shards that are counted in
+        worker processes, the per shard count tables are then summed.
+
+        :param paths: list of ARFF files with the same attributes
+        :param shards: Number of shards per file, defaults to one per process
+        :param processes: Number of worker processes, None for one per core
+        :return: the trained model
+        """
+        if shards is None:
+            shards = processes or multiprocessing.cpu_count()
+        attributes, shard_list = parallel.read_shards(paths, shards)
+        nb = cls.empty(attributes)
+        for stats in parallel.map_shard_statistics(nb, shard_list, processes):
+            nb.add_statistics(stats)
+        return nb
+
+    def save(self, path):
+        """
+        Writes the count tables and the log tables of
+        log_probability_tables to path, see modelfile for the format.
+        """
+        header = {'model': 'naivebayes', 'attributes': self.eval_data.attributes, 'total': self.total}
+        log_prior, log_conditionals = self.log_probability_tables()
+        arrays = [('class_counts', self.class_counts), ('log_prior', log_prior)]
+        for i, (counts, moments) in enumerate(zip(self.counts, self.moments)):
+            if counts is None:
+                arrays.append(('moments%d' % i, moments))
+            else:
+                arrays += [('counts%d' % i, counts), ('log_conditional%d' % i, log_conditionals[i])]
+        modelfile.write(path, header, arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: Name of a file written by save()
+        :return: a trained model, the count and log tables are read only
+            views into the memory mapped file. predict_proba indexes the
+            log tables in place, so processes that load the same file share
+            their pages, partial_fit copies them first.
+        """
+        header, arrays = modelfile.read(path)
+        if header['model'] != 'naivebayes':
+            raise ValueError('%s does not hold a naive bayes model' % path)
+
+        attributes = [tuple(attr) for attr in header['attributes']]
+        nb = cls.empty(attributes)
+        nb.total = header['total']
+        nb.class_counts = arrays['class_counts']
+        nb.counts = [arrays.get('counts%d' % i) for i in range(len(attributes) - 1)]
+        nb.moments = [arrays.get('moments%d' % i) for i in range(len(attributes) - 1)]
+        nb.log_tables = (arrays['log_prior'], [arrays.get('log_conditional%d' % i) for i in range(len(attributes) - 1)])
+        return nb
+
+    def load_test_data(self, testf):
+        """
+        Decodes testf into the Dataset test_data. The decoded data is
+        cached, so repeated calls for an unchanged file skip the parsing.
+        """
+        st = os.stat(testf)
+        key = (testf, st.st_size, st.st_mtime)
+        if self.test_cache is None or self.test_cache[0] != key:
+            self.test_cache = (key, Dataset.read(testf, cache = self.cache))
+        self.test_data = self.test_cache[1]
+
+    def joint_probabilities(self, data):
+        """
+        :param data: Dataset to score
+        :return: array with P(class = c) * P(row | class = c) for every row
+            of data and class c
+        """
+        class_counts = self.class_counts[:-1]
+        cp = np.tile((class_counts + 1) / (self.total + len(class_counts)), (len(data), 1))
+        for i, counts in enumerate(self.counts):
+            if counts is None:
+                cp *= np.exp(self.gaussian_log_likelihood(i, data.columns[i]))
+                continue
+            table = (counts[:, :-1] + 1) / (class_counts + counts.shape[0] - 1)
+            cp *= table[data.columns[i].astype(np.intp)]
+        return cp
+
     def classify(self, testf):
-        classifier = self.raw_data['attributes'][-1][0]
-        for v in self.raw_data['attributes']:
+        classifier = self.raw_data.attributes[-1][0]
+        for v in self.raw_data.attributes:
             if v[0] == classifier:
                 continue
             print(v[0] + " " + classifier)
         print("")
 
-        with open(testf) as f:
-            self.raw_test_data = self.arff.load(f)
-        self.test_data = copy.deepcopy(self.process_raw_data(self.raw_test_data['data']))
+        self.load_test_data(testf)
 
-        p = dict()
         correct = 0
-        for v in self.raw_data['attributes'][-1][1]:
-            p[v] = self.probability(classifier, v)
-
-        for td in self.test_data:
-            cplist = dict()
-            for ckey, cval in p.iteritems():
-                cp = cval
-                for key, value in td.iteritems():
-                    if key == classifier:
-                        continue
-                    cp *= self.conditional_probability(key, value, ckey, classifier)
-
-                cplist[ckey] = cp
+        cplist = self.joint_probabilities(self.test_data)
+        classes = self.test_data.columns[-1]
+        for i in range(len(self.test_data)):
+            tval = cplist[i].sum()
+            mval = cplist[i].argmax()
 
-            tval = sum(map(lambda (x, y): y, cplist.iteritems()))
-            mval = max(cplist.iteritems(), key=operator.itemgetter(1))
-
-            if mval[0] == td[classifier]:
+            if mval == classes[i]:
                 correct += 1
-            print(mval[0] + ' ' + td[classifier] + str(" %.12f" %(mval[1] / tval)).rstrip('0'))
+            print(self.test_data.value(-1, mval) + ' ' + self.test_data.value(-1, classes[i]) +
+                  str(" %.12f" %(cplist[i, mval] / tval)).rstrip('0'))
         print("\n" + str(correct))
-        return correct, len(self.raw_test_data['data'])
+        return correct, len(self.test_data)
 
-    def evaluate(self, tname):
+    def evaluate(self, tname, processes = 1):
+        """
+        :param tname: Name of the test file
+        :param processes: Number of worker processes for the runs, None for
+            one per core. The samples are drawn up front in the same order
+            as a serial evaluation, so the result does not depend on it.
+        :return: (correct, total, training size) for 4 runs per ratio
+        """
         random.seed(100)
         #ratios = [0.25, 0.5, 1]
         ratios = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
-        result = list()
+        runs = 4
 
-        self.raw_data = dict()
-        self.raw_data['attributes'] = self.eval_data['attributes']
+        samples = list()
         for r in ratios:
-            run = list()
-            for c in range(1, 5):
-                rindex = random.sample(range(0, len(self.eval_data['data'])), int(r * len(self.eval_data['data'])))
-                self.clean_training_data()
-                self.raw_data['data'] = list()
-                for i in rindex:
-                    self.raw_data['data'].append(self.eval_data['data'][i])
-                self.generate_model()
-                correct, total = self.classify(tname)
-                run.append((correct, total, int(r * len(self.eval_data['data']))))
-            result.append(run)
-        return result
+            for c in range(1, runs + 1):
+                rindex = random.sample(range(0, len(self.eval_data)), int(r * len(self.eval_data)))
+                samples.append((rindex,))
+
+        # decode the test set before the workers are forked
+        self.load_test_data(tname)
+        out = parallel.map_evaluate_runs(self, (tname,), samples, processes)
+        return [out[i:i + runs] for i in range(0, len(out), runs)]
+
+    def evaluate_run(self, tname, rindex):
+        self.clean_training_data()
+        self.raw_data = self.eval_data.take(rindex)
+        self.generate_model()
+        correct, total = self.classify(tname)
+        return correct, total, len(rindex)
 
 if __name__ == "__main__":
     nb = NaiveBayes(sys.argv[1])
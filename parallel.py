@@ -0,0 +1,215 @@
+"""
+Process pool helpers shared by the classifiers.
+
+Workers are forked from the calling process, so the model and everything
+it has already loaded (training data, cached test set) is inherited
+instead of being pickled for every task.
+"""
+
+import multiprocessing
+import os
+import sys
+import numpy as np
+import arff
+from dataset import Dataset
+
+_model = None
+_args = None
+
+def _init_worker(model, args):
+    global _model, _args
+    _model = model
+    _args = args
+    # the runs print their classification, keep the workers quiet
+    sys.stdout = open(os.devnull, 'w')
+
+def _call_method(sample):
+    return getattr(_model, _args[0])(*(_args[1:] + sample))
+
+def in_worker():
+    """
+    :return: True when called from a pool worker, which can not start a
+        pool of its own
+    """
+    return multiprocessing.current_process().daemon
+
+def map_method(model, name, args, samples, processes = 1):
+    """
+    Calls model.name(*(args + sample)) for every sample.
+
+    :param model: NaiveBayes or Tan instance
+    :param name: Name of the method to call
+    :param args: tuple of leading arguments shared by all calls
+    :param samples: list of tuples with the remaining arguments of each call
+    :param processes: Number of worker processes, None for one per core
+        and 1 to run everything in the calling process
+    :return: list with the result of every call, in the order of samples
+    """
+    if processes == 1 or len(samples) <= 1 or in_worker():
+        method = getattr(model, name)
+        return [method(*(args + sample)) for sample in samples]
+
+    pool = multiprocessing.Pool(processes, _init_worker, (model, (name,) + args))
+    try:
+        return pool.map(_call_method, samples, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+
+def map_evaluate_runs(model, args, samples, processes = 1):
+    """
+    :return: the result of model.evaluate_run for every sample, see
+        map_method
+    """
+    return map_method(model, 'evaluate_run', args, samples, processes)
+
+def read_arff_header(path):
+    """
+    :param path: Name of an ARFF file
+    :return: (header, offset) where header is the text of the file up to and
+        including the @DATA line and offset the byte where the data starts
+    """
+    with open(path, 'rb') as f:
+        header = list()
+        for line in iter(f.readline, b''):
+            header.append(line)
+            if line.strip().upper().startswith(b'@DATA'):
+                return b''.join(header), f.tell()
+    raise ValueError('%s has no @DATA section' % path)
+
+def split_data_section(path, offset, shards):
+    """
+    :return: list of (start, end) byte ranges that cover the data section
+        of path, every range starts at the beginning of a line
+    """
+    size = os.path.getsize(path)
+    bounds = [offset]
+    with open(path, 'rb') as f:
+        for k in range(1, shards):
+            f.seek(offset + (size - offset) * k // shards)
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def read_shards(paths, shards):
+    """
+    :param paths: list of ARFF files with the same attributes
+    :param shards: Number of shards per file
+    :return: (attributes, shards) where every shard is a
+        (path, header, start, end) tuple
+    """
+    attributes = None
+    out = list()
+    for path in paths:
+        header, offset = read_arff_header(path)
+        attrs = arff.loads(header.decode('utf-8'))['attributes']
+        if attributes is None:
+            attributes = attrs
+        elif attrs != attributes:
+            raise ValueError('%s does not have the attributes of %s' % (path, paths[0]))
+        for start, end in split_data_section(path, offset, shards):
+            out.append((path, header, start, end))
+    return attributes, out
+
+def decode_columns(shard, sample = None, seed = 0):
+    """
+    :param sample: Fraction of the lines to decode, every line is kept with
+        that probability before it is parsed, None to decode all of them
+    :param seed: Seed of the sample
+    :return: arff.loads of the header and the data section between start
+        and end, with return_type=arff.NUMPY
+    """
+    path, header, start, end = shard
+    with open(path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    if sample is not None:
+        lines = chunk.splitlines(True)
+        keep = np.random.RandomState(seed).random_sample(len(lines)) < sample
+        chunk = b''.join(line for line, k in zip(lines, keep) if k)
+    return arff.loads((header + chunk).decode('utf-8'), return_type=arff.NUMPY)
+
+def decode_shard(shard, sample = None, seed = 0):
+    """
+    :return: Dataset with the instances of the data section between start
+        and end, see decode_columns
+    """
+    return Dataset.from_columns(decode_columns(shard, sample, seed))
+
+def _decode_data(shard):
+    return decode_columns(shard)['data']
+
+def load_arff(path, processes = None, shards = None):
+    """
+    Decodes an ARFF file in worker processes. The data section is split
+    into line aligned byte ranges, every worker decodes its ranges into
+    NumPy columns and the columns are concatenated in file order. Line
+    numbers of decoding errors count from the start of the range.
+
+    :param path: Name of an ARFF file
+    :param processes: Number of worker processes, None for one per core
+        and 1 to decode in the calling process
+    :param shards: Number of byte ranges, defaults to one per process
+    :return: dictionary as returned by arff.load with return_type=arff.NUMPY
+    """
+    if shards is None:
+        shards = processes or multiprocessing.cpu_count()
+    header, offset = read_arff_header(path)
+    obj = arff.loads(header.decode('utf-8'), return_type=arff.NUMPY)
+    ranges = [(path, header, start, end) for start, end in split_data_section(path, offset, shards)]
+
+    if processes == 1 or len(ranges) <= 1 or in_worker():
+        parts = [_decode_data(shard) for shard in ranges]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_decode_data, ranges, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    columns, mask = obj['data']
+    if parts:
+        columns = [np.concatenate([part[0][i] for part in parts]) for i in range(len(columns))]
+        mask = np.concatenate([part[1] for part in parts])
+    obj['data'] = (columns, mask)
+    return obj
+
+def _count_shard(task):
+    shard, args, sample, seed = task
+    return getattr(_model, _args[0])(decode_shard(shard, sample, seed), *args)
+
+def map_shard_statistics(model, shards, processes = None, name = 'sufficient_statistics', args = None,
+                         sample = None, seed = 0):
+    """
+    :param model: NaiveBayes or Tan instance used to count every shard
+    :param shards: list of shards as returned by read_shards
+    :param processes: Number of worker processes, None for one per core
+        and 1 to count everything in the calling process
+    :param name: Name of the method that counts a decoded shard
+    :param args: list with a tuple of further arguments to that method for
+        every shard, None for no arguments
+    :param sample: Fraction of the lines of every shard to decode, None
+        for all of them
+    :param seed: Seed of the sample, shard k uses seed + k so the sample
+        does not depend on the number of processes
+    :return: (generator) model.name(shard data, *args) of every shard, in no
+        particular order
+    """
+    if args is None:
+        args = [()] * len(shards)
+    tasks = [(shard, shard_args, sample, seed + k) for k, (shard, shard_args) in enumerate(zip(shards, args))]
+    if processes == 1 or in_worker():
+        for shard, shard_args, _, shard_seed in tasks:
+            yield getattr(model, name)(decode_shard(shard, sample, shard_seed), *shard_args)
+        return
+
+    pool = multiprocessing.Pool(processes, _init_worker, (model, (name,)))
+    try:
+        for stats in pool.imap_unordered(_count_shard, tasks):
+            yield stats
+    finally:
+        pool.close()
+        pool.join()
@@ -1,173 +1,931 @@
 from __future__ import division
-import copy
+import hashlib
+import json
+import multiprocessing
+import os
 import sys
 import itertools
 import math
-import operator
 import random
+import numpy as np
+import modelfile
+import parallel
+from dataset import Dataset, is_nominal, row_columns
 
-class Vertex:
-    def __init__(self, id):
-        self.id = id
-        self.neighbors = dict()
-        # parents are used for quick lookups in directed graphs
-        self.parents = list()
+class Graph(object):
+    """Graph stored in flat arrays
 
-    def add_neighbor(self, v, weight = 0):
-        self.neighbors[v] = weight
+    Vertices are numbered in the order they are added, index maps every id
+    to its number. Edge weights are kept in a dense matrix with NaN where
+    there is no edge, and every vertex of a directed graph has at most one
+    parent, -1 for a root, which is all a tree needs.
+    """
+    def __init__(self, directed = False):
+        self.ids = list()
+        self.index = dict()
+        self.directed = directed
+        self._weights = np.zeros((0, 0))
+        self._parents = np.zeros(0, dtype=np.intp)
 
-    def add_parent(self, p):
-        self.parents.append(p)
+    def __len__(self):
+        return len(self.ids)
 
-    def get_neighbor_weight(self, v):
-        if self.neighbors.has_key(v):
-            return self.neighbors[v]
-        else:
-            return None
+    @property
+    def weights(self):
+        n = len(self.ids)
+        return self._weights[:n, :n]
 
-    def is_connected(self, v):
-        if self.neighbors.has_key(v):
-            return True
-        else:
-            return False
-
-class Graph:
-    def __init__(self, directed = False):
-        self.adjacency_list = list()
-        # vlist is for debugging purposes only
-        self.directed = directed
+    @property
+    def parents(self):
+        return self._parents[:len(self.ids)]
 
     def add_vertex(self, id):
-        v = Vertex(id)
-        self.adjacency_list.append(v)
+        """
+        :return: the number of the new vertex
+        """
+        n = len(self.ids)
+        if n == len(self._parents):
+            # grow by doubling, so adding n vertices costs O(n ** 2)
+            size = max(2 * n, 8)
+            weights = np.empty((size, size))
+            weights.fill(np.nan)
+            weights[:n, :n] = self._weights[:n, :n]
+            parents = np.empty(size, dtype=np.intp)
+            parents.fill(-1)
+            parents[:n] = self._parents
+            self._weights, self._parents = weights, parents
+        self.index[id] = n
+        self.ids.append(id)
+        return n
 
-    def get_vertex_by_id(self, id):
-        for v in self.adjacency_list:
-            if v.id == id:
-                return v
-        return None
+    def vertex(self, id):
+        v = self.index.get(id)
+        if v is None:
+            raise NameError('VertexNotFound')
+        return v
 
     def get_edge_weight(self, frm, to):
-        return frm.get_neighbor_weight(to)
+        """
+        :return: weight of the edge between the ids frm and to, None when
+            there is none
+        """
+        w = self._weights[self.vertex(frm), self.vertex(to)]
+        if np.isnan(w):
+            return None
+        return w
 
     def add_edge_by_id(self, frm, to, cost = 0):
-        v1 = self.get_vertex_by_id(frm)
-        v2 = self.get_vertex_by_id(to)
-
-        if not v1 or not v2:
-            raise NameError('VertexNotFound')
+        v1 = self.vertex(frm)
+        v2 = self.vertex(to)
 
-        v1.add_neighbor(v2, cost)
+        self._weights[v1, v2] = cost
 
         if not self.directed:
-            v2.add_neighbor(v1, cost)
+            self._weights[v2, v1] = cost
         else:
-            v2.add_parent(v1)
+            self._parents[v2] = v1
+
+    def parent_of(self, id):
+        """
+        :return: id of the parent of id, None for a root
+        """
+        p = self._parents[self.vertex(id)]
+        if p < 0:
+            return None
+        return self.ids[p]
+
+# upper bound on the cells of the arrays built per block of attribute pairs
+BLOCK_CELLS = 1 << 22
+# pairs with more (value 1, value 2, class) cells are counted sparsely
+SPARSE_CELLS = 1 << 16
+
+class SparseCounts(object):
+    """Pairwise count tensor that only stores the observed cells
+
+    keys holds the sorted flat index of every cell with a non zero count in
+    a tensor of the given shape and values the counts, so memory scales with
+    the rows counted and not with the product of the value spaces.
+    """
+    def __init__(self, shape, keys, values):
+        self.shape = shape
+        self.keys = keys
+        self.values = values
+
+    @classmethod
+    def count(cls, shape, cells):
+        """
+        :param cells: flat index of the cell of every row
+        """
+        keys, values = np.unique(cells, return_counts=True)
+        return cls(shape, keys, values.astype(np.intp))
+
+    def __iadd__(self, other):
+        # cells seen before are added in place, only new cells are inserted
+        at = np.searchsorted(self.keys, other.keys)
+        seen = at < len(self.keys)
+        seen[seen] = self.keys[at[seen]] == other.keys[seen]
+        self.values[at[seen]] += other.values[seen]
+        if not seen.all():
+            self.keys = np.insert(self.keys, at[~seen], other.keys[~seen])
+            self.values = np.insert(self.values, at[~seen], other.values[~seen])
+        return self
+
+    def __getitem__(self, index):
+        """
+        :param index: integers and full slices, one per axis, with Ellipsis
+            as in numpy
+        :return: dense array with the counts of the selected cells, only
+            that part of the tensor is built
+        """
+        if not isinstance(index, tuple):
+            index = (index,)
+        if Ellipsis in index:
+            k = index.index(Ellipsis)
+            index = index[:k] + (slice(None),) * (len(self.shape) - len(index) + 1) + index[k + 1:]
+        index = index + (slice(None),) * (len(self.shape) - len(index))
+
+        coords = np.unravel_index(self.keys, self.shape)
+        selected = np.ones(len(self.keys), dtype=bool)
+        free = list()
+        for axis, k in enumerate(index):
+            if isinstance(k, slice):
+                if k != slice(None):
+                    raise IndexError('SparseCounts only takes full slices')
+                free.append(axis)
+            else:
+                selected &= coords[axis] == k % self.shape[axis]
+        if not free:
+            return self.values[selected].sum()
+        out = np.zeros([self.shape[axis] for axis in free], dtype=np.intp)
+        out[tuple(coords[axis][selected] for axis in free)] = self.values[selected]
+        return out
+
+    def transpose(self):
+        """
+        :return: the counts with the first two axes swapped
+        """
+        v, w, c = np.unravel_index(self.keys, self.shape)
+        shape = (self.shape[1], self.shape[0], self.shape[2])
+        keys = np.ravel_multi_index((w, v, c), shape)
+        order = np.argsort(keys)
+        return SparseCounts(shape, keys[order], self.values[order])
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def toarray(self):
+        out = np.zeros(self.size, dtype=np.intp)
+        out[self.keys] = self.values
+        return out.reshape(self.shape)
+
+class SparseTable(object):
+    """Conditional probability table of a sparsely counted tree edge
+
+    Holds the SparseCounts [value, parent value, class] of the edge and the
+    number of rows with every parent value and class, the laplace estimate
+        P(value | parent value, class) = (count + 1) / (total + values)
+    of a cell is only worked out when it is looked up. Indexing with the
+    value and parent value codes of some rows gives the same array as the
+    dense table of make_probability_tables.
+    """
+    def __init__(self, counts, totals = None, log = False):
+        """
+        :param counts: SparseCounts indexed [value, parent value, class]
+            with the missing value and missing class slots last
+        :param totals: array [parent value, class] with the counts summed
+            over the values, worked out from counts when None
+        :param log: look up the logarithm of the estimates
+        """
+        self.counts = counts
+        self.nclasses = counts.shape[2] - 1
+        if totals is None:
+            v, pv, c = np.unravel_index(counts.keys, counts.shape)
+            known = c < self.nclasses
+            totals = np.bincount(pv[known] * self.nclasses + c[known], weights=counts.values[known],
+                                 minlength=counts.shape[1] * self.nclasses).reshape(counts.shape[1], self.nclasses)
+        self.totals = totals
+        self.log = log
+
+    def __getitem__(self, index):
+        size1, size2, size3 = self.counts.shape
+        v = np.asarray(index[0], dtype=np.intp) % size1
+        pv = np.asarray(index[1], dtype=np.intp) % size2
+        cells = ((v * size2 + pv) * size3)[..., np.newaxis] + np.arange(self.nclasses)
+
+        keys = self.counts.keys
+        count = np.zeros(cells.shape)
+        if len(keys):
+            at = np.minimum(np.searchsorted(keys, cells), len(keys) - 1)
+            count = np.where(keys[at] == cells, self.counts.values[at], 0)
+        table = (count + 1) / (self.totals[pv] + size1 - 1)
+        if self.log:
+            return np.log(table)
+        return table
+
+    def log_table(self):
+        """
+        :return: the table of the logarithm of the estimates, sharing the
+            counts of this one
+        """
+        return SparseTable(self.counts, self.totals, True)
+
+def pair_blocks(pairs, cells_per_pair):
+    """
+    :return: (generator) consecutive slices of pairs with at most
+        BLOCK_CELLS cells in total, at least one pair each
+    """
+    step = max(1, BLOCK_CELLS // max(cells_per_pair, 1))
+    for k in range(0, len(pairs), step):
+        yield pairs[k:k + step]
+
+def pair_histograms(cells, classes, sizes, nclasses, pairs):
+    """
+    Counts the joint (value i, value j, class) histograms of all pairs (i, j)
+    with one bincount over the combined codes of every row and pair.
+
+    :param cells: 2-D array with the value index of every row and attribute,
+        missing values mapped to the last index of the attribute
+    :param classes: class index of every row, missing mapped to the last one
+    :param sizes: number of indexes of every attribute, including missing
+    :param nclasses: number of class indexes, including missing
+    :param pairs: list of (i, j) attribute index pairs
+    :return: list with the count tensor of every pair, indexed
+        [value i, value j, class]
+    """
+    histograms = list()
+    width = max([sizes[k] for pair in pairs for k in pair] or [1])
+    cells_per_pair = width * width * nclasses
+    for block in pair_blocks(pairs, max(cells_per_pair, len(classes))):
+        first = np.array([i for i, j in block], dtype=np.intp)
+        second = np.array([j for i, j in block], dtype=np.intp)
+        offsets = np.arange(len(block), dtype=np.intp) * cells_per_pair
+        combined = (cells[:, first] * width + cells[:, second]) * nclasses + classes[:, np.newaxis] + offsets
+        counts = np.bincount(combined.ravel(), minlength=len(block) * cells_per_pair).reshape(
+            len(block), width, width, nclasses)
+        # copies, a view would keep the whole padded block alive
+        for k, (i, j) in enumerate(block):
+            histograms.append(counts[k, :sizes[i], :sizes[j]].copy())
+    return histograms
+
+def mutual_information_block(tensors, class_counts, total):
+    """
+    :param tensors: pairwise count tensors, indexed [value 1, value 2, class]
+        with the missing value and missing class slots last
+    :param class_counts: number of rows in every class, missing class last
+    :param total: number of rows
+    :return: array with the conditional mutual information of every pair
+        given the class, with laplace estimates of P(v1, v2 | class),
+        P(v1 | class), P(v2 | class) and P(v1, v2, class)
+    """
+    width1 = max(t.shape[0] for t in tensors)
+    width2 = max(t.shape[1] for t in tensors)
+    nclasses = len(class_counts) - 1
+    counts = np.zeros((len(tensors), width1, width2, nclasses))
+    for k, t in enumerate(tensors):
+        counts[k, :t.shape[0], :t.shape[1]] = t[:, :, :nclasses]
+
+    n1 = np.array([t.shape[0] - 1 for t in tensors], dtype=np.float64)[:, np.newaxis, np.newaxis, np.newaxis]
+    n2 = np.array([t.shape[1] - 1 for t in tensors], dtype=np.float64)[:, np.newaxis, np.newaxis, np.newaxis]
+    classcount = np.asarray(class_counts[:nclasses], dtype=np.float64)
+
+    jp2 = (counts + 1) / (classcount + n1 * n2)
+    jpattr1 = (counts.sum(axis=2, keepdims=True) + 1) / (classcount + n1)
+    jpattr2 = (counts.sum(axis=1, keepdims=True) + 1) / (classcount + n2)
+    jp3 = (counts + 1) / (total + n1 * n2 * nclasses)
+    terms = jp3 * np.log2(jp2 / (jpattr1 * jpattr2))
+
+    # the missing value slots and the padding only feed the marginals
+    declared = (np.arange(width1)[:, np.newaxis, np.newaxis] < n1) & \
+               (np.arange(width2)[:, np.newaxis] < n2)
+    return np.where(declared, terms, 0).sum(axis=(1, 2, 3))
+
+def round_weights(weights, digits = 12):
+    """
+    :return: weights rounded to digits significant digits. The mutual
+        information of a pair is summed along its own axis order, so equal
+        weights of different pairs can differ in the last bits, rounded they
+        compare equal and ties are broken by find_maximum_spanning_tree
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    magnitude = np.abs(weights)
+    magnitude[magnitude == 0] = 1
+    scale = 10.0 ** (digits - 1 - np.floor(np.log10(magnitude)))
+    return np.round(weights * scale) / scale
+
+def class_mutual_information(counts):
+    """
+    :param counts: count table [value, class] of one attribute with the
+        missing value and missing class slots last
+    :return: the mutual information of the attribute and the class over the
+        rows where both are known
+    """
+    joint = counts[:-1, :-1].astype(np.float64)
+    total = joint.sum()
+    if total == 0:
+        return 0.0
+    independent = joint.sum(axis=1)[:, np.newaxis] * joint.sum(axis=0)
+    seen = joint > 0
+    return float((joint[seen] / total * np.log2(joint[seen] * total / independent[seen])).sum())
+
+def structure_key(fname, attributes, candidates = None):
+    """
+    :return: hex digest identifying the training file fname by its content
+        and its attribute declarations, the key of the structure cache
+    """
+    digest = hashlib.sha1(json.dumps(attributes).encode('utf-8'))
+    if candidates is not None:
+        digest.update(('candidates=%d' % candidates).encode('utf-8'))
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def mutual_information_sparse(pair, counts1, counts2, class_counts, total):
+    """
+    The conditional mutual information of mutual_information_block for one
+    pair of SparseCounts. Only the observed cells are visited: the term of
+    an empty cell depends on the cell through the marginals alone, so the
+    terms of all cells taken as empty are summed in closed form and every
+    observed cell replaces its empty term by the actual one.
 
-class Tan:
-    def __init__(self, fname, evaluate = False):
+    :param pair: SparseCounts of the pair, indexed [value 1, value 2, class]
+    :param counts1: count table [value, class] of the first attribute, the
+        pair summed over the values of the second one
+    :param counts2: count table [value, class] of the second attribute
+    :param class_counts: number of rows in every class, missing class last
+    :param total: number of rows
+    :return: the conditional mutual information of the pair given the class
+    """
+    size1, size2, size3 = pair.shape
+    n1, n2, nclasses = size1 - 1, size2 - 1, size3 - 1
+    classcount = np.asarray(class_counts[:nclasses], dtype=np.float64)
+    log_jp2 = np.log2(classcount + n1 * n2)
+    log_jpattr1 = np.log2((counts1[:n1, :nclasses] + 1) / (classcount + n1))
+    log_jpattr2 = np.log2((counts2[:n2, :nclasses] + 1) / (classcount + n2))
+    jp3 = total + n1 * n2 * nclasses
+
+    empty = -(n1 * n2 * log_jp2 + n2 * log_jpattr1.sum(axis=0) + n1 * log_jpattr2.sum(axis=0)).sum()
+
+    v, w, c = np.unravel_index(pair.keys, pair.shape)
+    declared = (v < n1) & (w < n2) & (c < nclasses)
+    v, w, c = v[declared], w[declared], c[declared]
+    x = pair.values[declared].astype(np.float64)
+    marginals = log_jp2[c] + log_jpattr1[v, c] + log_jpattr2[w, c]
+    observed = ((x + 1) * np.log2(x + 1) - x * marginals).sum()
+    return (empty + observed) / jp3
+
+class Tan(object):
+    def __init__(self, fname, evaluate = False, processes = 1, cache_dir = None, candidates = None,
+                 relearn_rows = None, relearn_drift = 0.05, cache = False):
+        """
+        :param fname: Name of the training file
+        :param evaluate: Only load the data, evaluate() trains the models
+        :param processes: Number of worker processes used to decode the
+            training file and to compute the mutual information of the
+            attribute pairs, None for one per core
+        :param cache_dir: Directory that keeps the learned structure of every
+            training file, a rerun on an unchanged file reads the mutual
+            information matrix and the tree from it instead of learning them
+            and only counts the attribute pairs of the tree edges. Without
+            the other pairs partial_fit keeps that tree.
+        :param candidates: With candidates = k only the pairs of every
+            attribute with the k attributes that tell the most about the
+            class are counted and weighed, O(d * k) instead of O(d ** 2)
+            pairs for d attributes. None counts all of them.
+        :param relearn_rows: partial_fit keeps the tree until this many rows
+            were added since it was learned, then learns it again from the
+            updated counts. None disables the limit.
+        :param relearn_drift: partial_fit also learns the tree again once the
+            summed mutual information of its edges changed by this fraction,
+            None disables the limit
+        :param cache: Keep the decoded training and test files in sidecar
+            files, see Dataset.read
+        """
         self.arff = __import__("arff")
-        self.data = None
-        self.raw_test_data = None
+        self.setup(Dataset.read(fname, processes, cache))
+        self.processes = processes
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.candidates = candidates
+        self.relearn_rows = relearn_rows
+        self.relearn_drift = relearn_drift
+
+        if not evaluate:
+            self.raw_data = self.eval_data
+            if cache_dir is not None:
+                self.structure_key = structure_key(fname, self.eval_data.attributes, self.candidates)
+            self.generate_model()
+
+    def setup(self, eval_data):
+        self.processes = 1
         self.test_data = None
+        self.test_cache = None
+        self.cache = False
         self.attribute_dictionary = dict()
         self.bayes_net = Graph()
         self.spanning_tree = None
+        self.total = 0
+        self.class_counts = None
+        self.cpt_counts = None
+        self.statistics = None
+        self.tables = None
+        self.log_tables = None
+        self.pending_rows = 0
+        self.tree_weight = None
+        self.candidates = None
+        self.relearn_rows = None
+        self.relearn_drift = 0.05
+        self.cache_dir = None
+        self.structure_key = None
+        self.structure_error = 0.0
         self.attribute_no_lookup = dict()
-        with open(fname) as f:
-            self.eval_data = self.arff.load(f)
+        self.value_index = dict()
+        self.eval_data = eval_data
+        for attr in eval_data.attributes:
+            if not is_nominal(attr):
+                raise ValueError('TAN needs nominal attributes, %s is %s' % attr)
 
         i = 0
-        for v in self.eval_data['attributes']:
+        for v in self.eval_data.attributes:
             self.attribute_no_lookup[v[0]] = i
             i += 1
         self.make_attribute_dictionary()
 
-        if not evaluate:
-            self.raw_data = copy.deepcopy(self.eval_data)
-            self.generate_model()
-
     def generate_model(self):
-        self.data = copy.deepcopy(self.process_raw_data(self.raw_data['data']))
-        self.create_bayes_net()
-        self.find_maximum_spanning_tree()
+        self.statistics = None
+        if self.read_structure():
+            # the cached tree only needs the pairwise counts of its edges,
+            # without the other pairs partial_fit can not learn it again
+            self.relearn_rows = self.relearn_drift = None
+            self.add_statistics(self.sufficient_statistics(self.raw_data, self.tree_pairs()))
+            self.make_tree_tables()
+            return
+
+        pairs = None
+        if self.candidates is not None:
+            pairs = self.candidate_pairs(self.sufficient_statistics(self.raw_data, [])[2])
+        self.add_statistics(self.sufficient_statistics(self.raw_data, pairs))
+        self.generate_model_from_statistics()
+
+    def candidate_pairs(self, counts):
+        """
+        Ranks the attributes by class_mutual_information and pairs every
+        attribute with the candidates best ranked other ones. All attributes
+        are joined to the best ranked one, so the candidate graph is
+        connected and always has a spanning tree.
+
+        :param counts: count table [value, class] of every attribute
+        :return: sorted list of (i, j) attribute index pairs with i < j, None
+            when every pair is a candidate
+        """
+        k = self.candidates
+        if k is None or k >= len(counts) - 1:
+            return None
+        if k < 1:
+            raise ValueError('candidates must be at least 1, got %r' % k)
+        scores = [class_mutual_information(c) for c in counts]
+        ranked = sorted(range(len(counts)), key=lambda i: -scores[i])[:k + 1]
+        pairs = set()
+        for i in range(len(counts)):
+            for j in [j for j in ranked if j != i][:k]:
+                pairs.add((min(i, j), max(i, j)))
+        return sorted(pairs)
 
     def clean_training_data(self):
-        self.data = None
-        self.raw_test_data = None
         self.test_data = None
+        self.structure_key = None
         self.bayes_net = Graph()
         self.spanning_tree = None
+        self.cpt_counts = None
+        self.statistics = None
+        self.tables = None
+        self.log_tables = None
 
     def make_attribute_dictionary(self):
-        for attr in self.eval_data['attributes']:
+        for attr in self.eval_data.attributes:
             self.attribute_dictionary[attr[0]] = attr[1]
+            self.value_index[attr[0]] = dict((v, j) for j, v in enumerate(attr[1]))
 
-    def process_raw_data(self, raw_data):
-        res = list()
-        for rd in raw_data:
-            di = dict()
-            i = 0
-            for key in self.raw_data['attributes']:
-                di[key[0]] = rd[i]
-                i += 1
+    def value_cells(self, data):
+        """
+        :return: (classes, cells) with the class index of every row of data
+            and a 2-D array with the value index of every row and attribute,
+            missing values mapped to the last index
+        """
+        attributes = self.eval_data.attributes
+        classes = data.columns[-1].astype(np.intp) % (len(attributes[-1][1]) + 1)
+        cells = [data.columns[i].astype(np.intp) % (len(attr[1]) + 1) for i, attr in enumerate(attributes[:-1])]
+        return classes, np.column_stack(cells).reshape(len(data), len(cells))
 
-            res.append(di)
-        return res
+    def sufficient_statistics(self, data, pairs = None):
+        """
+        :param data: Dataset with the instances to count
+        :param pairs: list of (i, j) attribute index pairs with i < j to
+            count, None for all of them
+        :return: (total, class_counts, counts, pair_counts)
+            class_counts[c] is the number of rows in class c, counts[i][v, c]
+            the number of those rows with attribute i = v and
+            pair_counts[(i, j)][v, w, c] for i < j the number of rows with
+            attribute i = v and attribute j = w. Values and classes are
+            indexed by their position in the nominal declaration, the extra
+            last index counts rows where the value is missing.
+        """
+        attributes = self.eval_data.attributes
+        nclasses = len(attributes[-1][1]) + 1
+        sizes = [len(attr[1]) + 1 for attr in attributes[:-1]]
+        classes, cells = self.value_cells(data)
+
+        class_counts = np.bincount(classes, minlength=nclasses)
+        counts = list()
+        for i, n in enumerate(sizes):
+            counts.append(np.bincount(cells[:, i] * nclasses + classes, minlength=n * nclasses).reshape(n, nclasses))
+        if pairs is None:
+            pairs = list(itertools.combinations(range(len(sizes)), 2))
+        dense = [(i, j) for i, j in pairs if not self.is_sparse_pair(i, j)]
+        pair_counts = dict(zip(dense, pair_histograms(cells, classes, sizes, nclasses, dense)))
+        for i, j in pairs:
+            if self.is_sparse_pair(i, j):
+                pair_counts[(i, j)] = SparseCounts.count((sizes[i], sizes[j], nclasses),
+                                                         (cells[:, i] * sizes[j] + cells[:, j]) * nclasses + classes)
+        return len(data), class_counts, counts, pair_counts
+
+    def add_statistics(self, stats):
+        """
+        Merges the result of sufficient_statistics into the model, the count
+        arrays of statistics are updated in place.
+        """
+        if self.statistics is None:
+            self.statistics = stats
+            return
+        total, class_counts, counts, pair_counts = self.statistics
+        class_counts += stats[1]
+        for a, b in zip(counts, stats[2]):
+            a += b
+        for k, v in pair_counts.items():
+            v += stats[3][k]
+        self.statistics = (total + stats[0], class_counts, counts, pair_counts)
+
+    def add_rows(self, data):
+        """
+        Counts the instances of data into statistics in place, for the pairs
+        statistics already holds. Unlike add_statistics no count tensors are
+        built for the rows, so the cost depends on the rows and not on the
+        size of the model.
+        """
+        total, class_counts, counts, pair_counts = self.statistics
+        classes, cells = self.value_cells(data)
+        np.add.at(class_counts, classes, 1)
+        for i, table in enumerate(counts):
+            np.add.at(table, (cells[:, i], classes), 1)
+        for (i, j), pair in pair_counts.items():
+            if isinstance(pair, SparseCounts):
+                size1, size2, size3 = pair.shape
+                pair += SparseCounts.count(pair.shape, (cells[:, i] * size2 + cells[:, j]) * size3 + classes)
+            else:
+                np.add.at(pair, (cells[:, i], cells[:, j], classes), 1)
+        self.statistics = (total + len(data), class_counts, counts, pair_counts)
+
+    def is_sparse_pair(self, i, j):
+        """
+        :return: True when the counts of attributes i and j are kept as
+            SparseCounts, see SPARSE_CELLS
+        """
+        attributes = self.eval_data.attributes
+        cells = (len(attributes[i][1]) + 1) * (len(attributes[j][1]) + 1) * (len(attributes[-1][1]) + 1)
+        return cells > SPARSE_CELLS
+
+    def pair_counts(self, i, j):
+        """
+        :return: the pairwise count tensor of attributes i and j from
+            statistics, indexed [value of i, value of j, class], as
+            SparseCounts when the pair is counted sparsely
+        """
+        counts = self.statistics[3][(min(i, j), max(i, j))]
+        if i < j:
+            return counts
+        if isinstance(counts, SparseCounts):
+            return counts.transpose()
+        return counts.transpose(1, 0, 2)
 
     def create_bayes_net(self):
-        # add vertices to graph, dont add the classifier
-        classifier = self.raw_data['attributes'][-1][0]
-        for attr in self.attribute_dictionary.keys():
-            if attr == classifier:
+        # add vertices to graph, dont add the classifier. Vertex k is
+        # attribute k, so the weight matrix is indexed like the attributes
+        for attr in self.raw_data.attributes[:-1]:
+            self.bayes_net.add_vertex(attr[0])
+
+        # edge weights come from the pairwise count tensors in statistics,
+        # there is no pass over the training rows per attribute pair. Pairs
+        # that were not counted (see candidates) have no edge
+        pairs = sorted(self.statistics[3])
+        if len(pairs) == 0:
+            return
+        first, second = np.array(pairs, dtype=np.intp).T
+        weights = self.bayes_net.weights
+        weights[first, second] = weights[second, first] = self.mutual_information(pairs)
+
+    def mutual_information(self, pairs, processes = None):
+        """
+        :param pairs: list of (i, j) attribute index pairs
+        :param processes: Number of worker processes, defaults to the
+            processes of the model and 1 computes every block in the calling
+            process
+        :return: array with the conditional mutual information of every pair
+            given the class, see mutual_information_block and round_weights
+        """
+        if processes is None:
+            processes = self.processes
+        if len(pairs) == 0:
+            return np.zeros(0)
+        dense = [(i, j) for i, j in pairs if not self.is_sparse_pair(i, j)]
+        sparse = [(i, j) for i, j in pairs if self.is_sparse_pair(i, j)]
+        attributes = self.raw_data.attributes
+        width = max([len(attributes[k][1]) + 1 for pair in dense for k in pair] or [1])
+        blocks = [(block,) for block in pair_blocks(dense, width * width * len(self.statistics[1]))]
+        blocks += [([pair],) for pair in sparse]
+        # every block is computed the same way in the workers, so the
+        # result does not depend on the number of processes
+        out = parallel.map_method(self, 'mutual_information_of_block', (), blocks, processes)
+        weights = dict(zip(dense + sparse, np.concatenate(out)))
+        return round_weights([weights[pair] for pair in pairs])
+
+    def mutual_information_of_block(self, block):
+        if self.is_sparse_pair(*block[0]):
+            i, j = min(block[0]), max(block[0])
+            total, class_counts, counts = self.statistics[:3]
+            cmi = mutual_information_sparse(self.statistics[3][(i, j)], counts[i], counts[j], class_counts, total)
+            return np.array([cmi])
+        tensors = [self.pair_counts(i, j) for i, j in block]
+        return mutual_information_block(tensors, self.statistics[1], self.statistics[0])
+
+    def generate_model_from_statistics(self):
+        """
+        Learns the tree and the conditional probability tables from
+        statistics alone, without any training rows.
+
+        cpt_counts[i] is counts[i] from statistics for the root of the tree
+        and the pairwise tensor of attribute i and its parent, indexed
+        [value, parent value, class], for every other attribute. Sparsely
+        counted edges keep their SparseCounts. The probability tables are
+        built from them once, see make_probability_tables.
+        """
+        self.learn_structure()
+        self.write_structure()
+        self.make_tree_tables()
+
+    def make_tree_tables(self):
+        """
+        Takes the tables of the current tree from statistics and starts
+        tracking its drift, see structure_is_stale.
+        """
+        self.pending_rows = 0
+        self.tree_weight = self.tree_mutual_information()
+        self.make_cpt_counts()
+
+    def tree_pairs(self):
+        """
+        :return: sorted list of the (i, j) attribute index pairs with i < j
+            of the tree edges
+        """
+        return sorted((min(i, p), max(i, p)) for i, p in enumerate(self.parent_columns()) if p is not None)
+
+    def learn_structure(self):
+        self.bayes_net = Graph()
+        self.create_bayes_net()
+        self.find_maximum_spanning_tree()
+
+    def learn_sampled_structure(self, shards, sample, seed = 0, delta = 0.05):
+        """
+        Learns the tree from the pairwise counts of a row sample of shards.
+        The lines of the sample are picked before they are decoded, so only
+        that fraction of the data section is parsed.
+
+        structure_error is set to a bound on the absolute error of every
+        joint frequency P(value i, value j, class) estimated from the
+        sample, by Hoeffding's inequality with a union bound over all the
+        pairwise cells. It holds with probability 1 - delta.
+
+        :param shards: list of shards as returned by parallel.read_shards
+        :param sample: fraction of the rows to count
+        :param seed: seed of the sample, see parallel.map_shard_statistics
+        """
+        if not 0 < sample <= 1:
+            raise ValueError('sample must be in (0, 1], got %r' % sample)
+        self.statistics = None
+        for stats in parallel.map_shard_statistics(self, shards, self.processes, sample = sample, seed = seed):
+            self.add_statistics(stats)
+        if self.statistics is None:
+            self.add_statistics(self.sufficient_statistics(self.raw_data))
+        self.learn_structure()
+
+        rows = self.statistics[0]
+        cells = max(sum(t.size for t in self.statistics[3].values()), 1)
+        self.structure_error = math.sqrt(math.log(2 * cells / delta) / (2 * rows)) if rows else 1.0
+        self.statistics = None
+
+    def structure_path(self):
+        """
+        :return: Name of the structure cache file of the training data, None
+            when the model was not trained on a whole file with a cache_dir
+        """
+        if self.cache_dir is None or self.structure_key is None:
+            return None
+        return os.path.join(self.cache_dir, 'tan-%s.bin' % self.structure_key)
+
+    def read_structure(self):
+        """
+        Restores bayes_net and spanning_tree from the structure cache.
+
+        :return: False when there is no usable cache file
+        """
+        path = self.structure_path()
+        if path is None or not os.path.exists(path):
+            return False
+        try:
+            header, arrays = modelfile.read(path)
+        except (IOError, ValueError):
+            return False
+        if header.get('model') != 'tan-structure':
+            return False
+
+        self.bayes_net = Graph()
+        for attr in self.raw_data.attributes[:-1]:
+            self.bayes_net.add_vertex(attr[0])
+        self.bayes_net.weights[:] = arrays['weights']
+        self.make_spanning_tree(header['parents'])
+        return True
+
+    def write_structure(self):
+        """
+        Stores the mutual information matrix and the parent of every
+        attribute in the structure cache, see modelfile for the format.
+        """
+        path = self.structure_path()
+        if path is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        parents = [self.parent_of(attr[0]) for attr in self.raw_data.attributes[:-1]]
+        header = {'model': 'tan-structure', 'attributes': self.raw_data.attributes, 'parents': parents}
+        # write next to the final name and rename, readers never see a
+        # partial file
+        tmp = '%s.%d' % (path, os.getpid())
+        modelfile.write(tmp, header, [('weights', self.bayes_net.weights)])
+        os.rename(tmp, path)
+
+    def make_spanning_tree(self, parents):
+        """
+        :param parents: name of the parent of every attribute but the
+            class, in declaration order, None for the root
+        """
+        self.spanning_tree = Graph(directed = True)
+        for attr in self.raw_data.attributes[:-1]:
+            self.spanning_tree.add_vertex(attr[0])
+        for attr, parent in zip(self.raw_data.attributes[:-1], parents):
+            if parent is not None:
+                self.spanning_tree.add_edge_by_id(parent, attr[0])
+
+    def make_cpt_counts(self):
+        """
+        Takes cpt_counts for the current tree from statistics and builds the
+        probability tables.
+        """
+        self.total, self.class_counts, counts = self.statistics[:3]
+        self.cpt_counts = list()
+        for i, attr in enumerate(self.raw_data.attributes[:-1]):
+            pname = self.parent_of(attr[0])
+            if pname is None:
+                self.cpt_counts.append(counts[i])
+            else:
+                self.cpt_counts.append(self.pair_counts(i, self.attribute_no_lookup[pname]))
+        self.make_probability_tables()
+
+    def tree_mutual_information(self, processes = None):
+        """
+        :param processes: see mutual_information
+        :return: the summed conditional mutual information of the tree
+            edges under the current statistics
+        """
+        pairs = [(i, p) for i, p in enumerate(self.parent_columns()) if p is not None]
+        return float(self.mutual_information(pairs, processes).sum())
+
+    def structure_is_stale(self):
+        """
+        :return: True when the tree should be learned again, see the
+            relearn_rows and relearn_drift parameters of Tan
+        """
+        if self.relearn_rows is not None and self.pending_rows >= self.relearn_rows:
+            return True
+        if self.relearn_drift is not None:
+            # runs on every partial_fit, the d - 1 tree edges are cheaper in
+            # the calling process than in a new pool
+            drift = abs(self.tree_mutual_information(processes = 1) - self.tree_weight)
+            return drift > self.relearn_drift * self.tree_weight
+        return False
+
+    def partial_fit(self, rows):
+        """
+        Adds new training instances to the model. The rows are counted into
+        statistics in place and only the estimates they change are worked
+        out again, see update_probability_tables, which costs one pass over
+        the new rows and no mutual information beyond the tree edges. The
+        tree itself is only learned again once structure_is_stale, until
+        then the old one keeps serving. raw_data keeps the data of the last
+        full training.
+
+        :param rows: Dataset or list of instances, each a list of values in
+            attribute order as returned by arff.load
+        """
+        if self.statistics is None:
+            raise ValueError('partial_fit needs the counts of a trained model, a loaded model has none')
+        if not isinstance(rows, Dataset):
+            rows = Dataset.from_rows(self.eval_data.attributes, rows)
+        self.add_rows(rows)
+        self.pending_rows += len(rows)
+        # the counts no longer match the file the cache entry belongs to
+        self.structure_key = None
+
+        if self.structure_is_stale():
+            self.generate_model_from_statistics()
+        else:
+            self.update_probability_tables(rows)
+
+    def update_probability_tables(self, data):
+        """
+        Brings cpt_counts and the probability tables of the current tree up
+        to date after add_rows(data). cpt_counts share their arrays with
+        statistics, except for the transposed counts of a sparse edge.
+        Only the prior, the columns of the classes of data in the table of
+        the root and the (parent value, class) columns of data in the table
+        of every other attribute are worked out again.
+        """
+        self.total = self.statistics[0]
+        classes, cells = self.value_cells(data)
+        nclasses = len(self.class_counts) - 1
+        prior, conditionals = self.tables
+        prior[:] = (self.class_counts[:-1] + 1) / (self.total + nclasses)
+        if self.log_tables is not None:
+            self.log_tables[0][:] = np.log(prior)
+
+        known = classes < nclasses
+        for i, p in enumerate(self.parent_columns()):
+            counts, table = self.cpt_counts[i], conditionals[i]
+            if isinstance(table, SparseTable):
+                if i > p:
+                    size1, size2, size3 = counts.shape
+                    counts += SparseCounts.count(counts.shape, (cells[:, i] * size2 + cells[:, p]) * size3 + classes)
+                np.add.at(table.totals, (cells[known, p], classes[known]), 1)
                 continue
-            self.bayes_net.add_vertex(attr)
-
-        for v1, v2 in itertools.combinations(self.bayes_net.adjacency_list, 2):
-            attr1 = v1.id
-            attr2 = v2.id
-            mutual_information = 0
-            for classval in self.attribute_dictionary[classifier]:
-                for attrval1, attrval2 in itertools.product(self.attribute_dictionary[attr1],
-                                                            self.attribute_dictionary[attr2]):
-                    #print(attr1, attrval1, attr2, attrval2, classval)
-                    jp2 = self.conditional_probabilty2(attr1, attrval1, attr2, attrval2, classval, classifier)
-                    jpattr1 = self.conditional_probability(attr1, attrval1, classval, classifier)
-                    jpattr2 = self.conditional_probability(attr2, attrval2, classval, classifier)
-                    jp3 = self.joint_probability3(attr1, attrval1, attr2, attrval2, classifier, classval)
-                    #print(jp2, jpattr1, jpattr2, jp3, jp2/(jpattr1*jpattr2))
-                    mutual_information += jp3 * math.log(jp2/(jpattr1*jpattr2), 2)
-            #print(attr1, attr2, mutual_information)
-            self.bayes_net.add_edge_by_id(attr1, attr2, mutual_information)
+            if p is None:
+                index = (slice(None), np.unique(classes[known]))
+            else:
+                columns = np.unique(cells[known, p] * nclasses + classes[known])
+                index = (slice(None), columns // nclasses, columns % nclasses)
+            block = counts[index]
+            table[index] = (block + 1) / (block.sum(axis=0) + counts.shape[0] - 1)
+            if self.log_tables is not None:
+                self.log_tables[1][i][index] = np.log(table[index])
 
     def find_maximum_spanning_tree(self):
+        """
+        Prim's algorithm over the dense weight matrix of bayes_net, O(n ** 2)
+        for n attributes. best[q] holds the heaviest edge from the tree to
+        attribute q and best_parent[q] its tree end.
+
+        Ties go to the edge whose tree end joined the tree first and then to
+        the attribute declared first, the order in which a scan over every
+        (tree vertex, remaining attribute) pair would meet them.
+        """
         self.spanning_tree = Graph(directed = True)
-        Q = list()
-        for v in self.raw_data['attributes']:
-            if v[0] == self.raw_data['attributes'][-1][0]:
-                continue
-            Q.append(v[0])
-        self.spanning_tree.add_vertex(Q.pop(0))
-
-        while True:
-            if len(Q) == 0:
-                break
-            max_weight = -1
-            next_vertex = None
-            for vertex in self.spanning_tree.adjacency_list:
-                for q_vertex in Q:
-                    bn_vertex_a = self.bayes_net.get_vertex_by_id(vertex.id)
-                    bn_vertex_q = self.bayes_net.get_vertex_by_id(q_vertex)
-                    val = bn_vertex_a.get_neighbor_weight(bn_vertex_q)
-                    if val > max_weight:
-                        max_weight = val
-                        next_vertex = q_vertex
-                        parent_vertex = vertex
-            self.spanning_tree.add_vertex(next_vertex)
-            self.spanning_tree.add_edge_by_id(parent_vertex.id, next_vertex, max_weight)
-            Q.remove(next_vertex)
-            #print(self.attribute_no_lookup[parent_vertex.id], self.attribute_no_lookup[next_vertex.id])
+        ids = self.bayes_net.ids
+        weights = self.bayes_net.weights
+        n = len(ids)
+        best = np.empty(n)
+        best.fill(-1)
+        best_parent = np.zeros(n, dtype=np.intp)
+        rank = np.zeros(n, dtype=np.intp)
+        remaining = np.ones(n, dtype=bool)
+
+        vertex = 0
+        remaining[vertex] = False
+        self.spanning_tree.add_vertex(ids[vertex])
+        for k in range(1, n):
+            # strict >, an edge from a later tree vertex never displaces an
+            # equally heavy one found before it. NaN marks a missing edge
+            with np.errstate(invalid='ignore'):
+                closer = remaining & (weights[vertex] > best)
+            best[closer] = weights[vertex][closer]
+            best_parent[closer] = vertex
+
+            candidates = np.flatnonzero(remaining)
+            heaviest = best[candidates]
+            ties = candidates[heaviest == heaviest.max()]
+            vertex = ties[np.argmin(rank[best_parent[ties]])]
 
+            rank[vertex] = k
+            remaining[vertex] = False
+            self.spanning_tree.add_vertex(ids[vertex])
+            self.spanning_tree.add_edge_by_id(ids[best_parent[vertex]], ids[vertex], best[vertex])
 
     def conditional_probability(self, fname, fval, classifierval, classifier = 'class', laplace = True):
         """
@@ -179,8 +937,11 @@ class Tan:
         :return: Conditional Probability
             P(fname = fval | classifier = classifierval)
         """
-        total = len([1 for d in self.data if d[classifier] == classifierval])
-        conditional_count = len([1 for d in self.data if d[classifier] == classifierval and d[fname] == fval])
+        c = self.value_index[classifier].get(classifierval, -1)
+        v = self.value_index[fname].get(fval, -1)
+        counts = self.cpt_counts[self.attribute_no_lookup[fname]]
+        total = int(self.class_counts[c])
+        conditional_count = int(counts[v, ..., c].sum())
 
         if laplace:
             conditional_count += 1
@@ -188,23 +949,18 @@ class Tan:
 
         return conditional_count / total
 
-    def conditional_probabilty2(self, fname1, fval1, fname2, fval2, classifierval, classifier = 'class',
-                                laplace = True):
-        total = len([1 for d in self.data if d[classifier] == classifierval])
-        conditional_count = len([1 for d in self.data if d[fname1] == fval1 and d[fname2] == fval2 and
-                                 d[classifier] == classifierval])
-
-        if laplace:
-            conditional_count += 1
-            total += len(self.attribute_dictionary[fname1]) * len(self.attribute_dictionary[fname2])
-
-        return conditional_count / total
-
     def conditional_probability_by2(self, fname1, fval1, pname, pval, classifierval, classifier = 'class',
                                     laplace = True):
-        total = len([1 for d in self.data if d[classifier] == classifierval and d[pname] == pval])
-        conditional_count = len([1 for d in self.data if d[classifier] == classifierval and d[pname] == pval and
-                                d[fname1] == fval1])
+        c = self.value_index[classifier].get(classifierval, -1)
+        v = self.value_index[fname1].get(fval1, -1)
+        pv = self.value_index[pname].get(pval, -1)
+        i = self.attribute_no_lookup[fname1]
+        if self.parent_of(fname1) == pname:
+            counts = self.cpt_counts[i]
+        else:
+            counts = self.pair_counts(i, self.attribute_no_lookup[pname])
+        total = int(counts[:, pv, c].sum())
+        conditional_count = int(counts[v, pv, c])
 
         if laplace:
             conditional_count += 1
@@ -221,8 +977,12 @@ class Tan:
         :return: Probability
             P(fname = fval)
         """
-        total = len(self.data)
-        count = sum(1 for d in self.data if d[fname] == fval)
+        v = self.value_index[fname].get(fval, -1)
+        total = self.total
+        if fname == self.eval_data.attributes[-1][0]:
+            count = int(self.class_counts[v])
+        else:
+            count = int(self.cpt_counts[self.attribute_no_lookup[fname]][v].sum())
 
         if laplace:
             total += len(self.attribute_dictionary[fname])
@@ -230,85 +990,311 @@ class Tan:
 
         return count / total
 
-    def joint_probability3(self, fname1, fval1, fname2, fval2, fname3, fval3, laplace = True):
-        total = len(self.data)
-        count = len([1 for d in self.data if d[fname1] == fval1 and d[fname2] == fval2 and d[fname3] == fval3])
+    def parent_of(self, fname):
+        return self.spanning_tree.parent_of(fname)
 
-        if laplace:
-            count += 1
-            total += len(self.attribute_dictionary[fname1]) * len(self.attribute_dictionary[fname2]) * \
-                     len(self.attribute_dictionary[fname3])
+    def make_probability_tables(self):
+        """
+        Builds tables = (prior, conditionals) from class_counts and
+        cpt_counts, with Laplace estimates
+            prior[c] = P(class = c)
+            conditionals[i][v, c] = P(attribute i = v | class = c)
+                for the root of the tree and
+            conditionals[i][v, pv, c] = P(attribute i = v | parent = pv, class = c)
+                for every other attribute.
+        Values are indexed by their position in the nominal declaration and
+        the extra last index holds the estimate for a missing value. The
+        table of a sparsely counted edge is a SparseTable, indexed the same.
+        """
+        class_counts = self.class_counts[:-1]
+        prior = (class_counts + 1) / (self.total + len(class_counts))
 
-        return count / total
+        conditionals = list()
+        for counts in self.cpt_counts:
+            if isinstance(counts, SparseCounts):
+                conditionals.append(SparseTable(counts))
+                continue
+            counts = counts[..., :-1]
+            totals = counts.sum(axis=0)
+            conditionals.append((counts + 1) / (totals + counts.shape[0] - 1))
+
+        self.tables = (prior, conditionals)
+        self.log_tables = None
+
+    def probability_tables(self):
+        """
+        :return: tables, a loaded model only builds them when they are
+            first needed and keeps the log tables of its file
+        """
+        if self.tables is None:
+            log_tables = self.log_tables
+            self.make_probability_tables()
+            self.log_tables = log_tables
+        return self.tables
+
+    def log_probability_tables(self):
+        """
+        :return: (log_prior, log_conditionals), the logarithm of every table
+            built by make_probability_tables
+        """
+        if self.log_tables is None:
+            prior, conditionals = self.tables
+            self.log_tables = (np.log(prior), [table.log_table() if isinstance(table, SparseTable) else np.log(table)
+                                               for table in conditionals])
+        return self.log_tables
+
+    def parent_columns(self):
+        """
+        :return: list with the attribute index of the parent of every
+            attribute, None for the root of the tree
+        """
+        parents = list()
+        for attr in self.raw_data.attributes[:-1]:
+            pname = self.parent_of(attr[0])
+            parents.append(None if pname is None else self.attribute_no_lookup[pname])
+        return parents
+
+    def predict_proba(self, rows):
+        """
+        :param rows: Dataset or 2-D array of integer coded instances, one
+            column per attribute in declaration order, the class column may
+            be left out. Missing values are coded as -1.
+        :return: array with P(class = c | row) for every row and class c
+        """
+        log_prior, log_conditionals = self.log_probability_tables()
+        columns = [column.astype(np.intp) for column in row_columns(rows)]
+
+        log_posterior = np.tile(log_prior, (len(columns[0]), 1))
+        for i, (table, p) in enumerate(zip(log_conditionals, self.parent_columns())):
+            if p is None:
+                log_posterior += table[columns[i]]
+            else:
+                log_posterior += table[columns[i], columns[p]]
+
+        log_posterior -= log_posterior.max(axis=1)[:, np.newaxis]
+        posterior = np.exp(log_posterior)
+        return posterior / posterior.sum(axis=1)[:, np.newaxis]
+
+    def predict(self, rows):
+        """
+        :param rows: Dataset or 2-D array of coded instances, see predict_proba
+        :return: array with the index of the most probable class for every row
+        """
+        return self.predict_proba(rows).argmax(axis=1)
+
+    @classmethod
+    def empty(cls, attributes):
+        """
+        :param attributes: attribute declarations as returned by arff.load
+        :return: an untrained model without any training data
+        """
+        t = cls.__new__(cls)
+        t.arff = __import__("arff")
+        t.setup(Dataset.empty(attributes))
+        t.raw_data = t.eval_data
+        return t
+
+    @classmethod
+    def train_sharded(cls, paths, shards = None, processes = None, sample = None, candidates = None,
+                      relearn_rows = None, relearn_drift = 0.05):
+        """
+        Trains on the data sections of one or more ARFF files without loading
+        them. Every file is split into line aligned shards that are counted in
+        worker processes, the per shard class, attribute|class and pairwise
+        attribute|class counts are then summed and the model is learned from
+        the merged counts.
+
+        With sample, the tree is learned from the pairwise counts of that
+        fraction of the rows (see learn_sampled_structure) and a second pass
+        over all rows counts exactly what the conditional probability tables
+        need, the pairs of the tree edges only. The statistics of such a
+        model do not hold the other pairs, so partial_fit never learns its
+        tree again. Without sample and with candidates set, a first pass
+        counts the attributes alone to choose the candidate pairs.
+
+        :param paths: list of ARFF files with the same attributes
+        :param shards: Number of shards per file, defaults to one per process
+        :param processes: Number of worker processes for the counting and the
+            mutual information, None for one per core
+        :param sample: Fraction of the rows used to learn the tree, None to
+            learn it from all of them
+        :param candidates: see Tan
+        :param relearn_rows: see Tan, ignored with sample
+        :param relearn_drift: see Tan, ignored with sample
+        :return: the trained model
+        """
+        if shards is None:
+            shards = processes or multiprocessing.cpu_count()
+        attributes, shard_list = parallel.read_shards(paths, shards)
+        t = cls.empty(attributes)
+        t.processes = processes
+        t.candidates = candidates
+        t.relearn_rows = relearn_rows
+        t.relearn_drift = relearn_drift
+        pairs = None
+        if sample is None and t.candidates is not None:
+            t.statistics = None
+            for stats in parallel.map_shard_statistics(t, shard_list, processes, args = [([],)] * len(shard_list)):
+                t.add_statistics(stats)
+            if t.statistics is not None:
+                pairs = t.candidate_pairs(t.statistics[2])
+            t.statistics = None
+        if sample is not None:
+            t.learn_sampled_structure(shard_list, sample)
+            pairs = t.tree_pairs()
+            t.relearn_rows = t.relearn_drift = None
+
+        args = [(pairs,)] * len(shard_list)
+        for stats in parallel.map_shard_statistics(t, shard_list, processes, args = args):
+            t.add_statistics(stats)
+        if t.statistics is None:
+            t.add_statistics(t.sufficient_statistics(t.raw_data, pairs))
+        if sample is None:
+            t.generate_model_from_statistics()
+        else:
+            t.make_tree_tables()
+        return t
+
+    def save(self, path):
+        """
+        Writes the tree, the counts of the conditional probability tables
+        and the log tables of log_probability_tables to path, see modelfile
+        for the format.
+        """
+        attributes = self.raw_data.attributes
+        parents = [self.parent_of(attr[0]) for attr in attributes[:-1]]
+        # the cpt of a sparsely counted edge is stored as its keys, values
+        # and totals, its log estimates are worked out on lookup
+        shapes = [list(counts.shape) if isinstance(counts, SparseCounts) else None for counts in self.cpt_counts]
+        header = {'model': 'tan', 'attributes': attributes, 'parents': parents, 'total': self.total,
+                  'sparse': shapes}
+        log_prior, log_conditionals = self.log_probability_tables()
+        arrays = [('class_counts', self.class_counts), ('log_prior', log_prior)]
+        for i, (counts, table) in enumerate(zip(self.cpt_counts, log_conditionals)):
+            if isinstance(counts, SparseCounts):
+                arrays += [('cpt%d_keys' % i, counts.keys), ('cpt%d_values' % i, counts.values),
+                           ('cpt%d_totals' % i, table.totals)]
+            else:
+                arrays += [('cpt%d' % i, counts), ('log_cpt%d' % i, table)]
+        modelfile.write(path, header, arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: Name of a file written by save()
+        :return: a trained model, the counts and log tables are read only
+            views into the memory mapped file. predict_proba indexes the
+            log tables in place, so processes that load the same file share
+            their pages.
+        """
+        header, arrays = modelfile.read(path)
+        if header['model'] != 'tan':
+            raise ValueError('%s does not hold a TAN model' % path)
+
+        attributes = [tuple(attr) for attr in header['attributes']]
+        t = cls.empty(attributes)
+        t.make_spanning_tree(header['parents'])
+
+        t.total = header['total']
+        t.class_counts = arrays['class_counts']
+        t.cpt_counts = list()
+        log_conditionals = list()
+        for i, shape in enumerate(header['sparse']):
+            if shape is None:
+                t.cpt_counts.append(arrays['cpt%d' % i])
+                log_conditionals.append(arrays['log_cpt%d' % i])
+            else:
+                counts = SparseCounts(tuple(shape), arrays['cpt%d_keys' % i], arrays['cpt%d_values' % i])
+                t.cpt_counts.append(counts)
+                log_conditionals.append(SparseTable(counts, arrays['cpt%d_totals' % i], True))
+        t.log_tables = (arrays['log_prior'], log_conditionals)
+        return t
+
+    def load_test_data(self, testf):
+        """
+        Decodes testf into the Dataset test_data. The decoded data is
+        cached, so repeated calls for an unchanged file skip the parsing.
+        """
+        st = os.stat(testf)
+        key = (testf, st.st_size, st.st_mtime)
+        if self.test_cache is None or self.test_cache[0] != key:
+            self.test_cache = (key, Dataset.read(testf, cache = self.cache))
+        self.test_data = self.test_cache[1]
+
+    def joint_probabilities(self, data):
+        """
+        :param data: Dataset to score
+        :return: array with P(class = c) * P(row | class = c) for every row
+            of data and class c, read from the probability tables
+        """
+        prior, conditionals = self.probability_tables()
+        cp = np.tile(prior, (len(data), 1))
+        for i, (table, p) in enumerate(zip(conditionals, self.parent_columns())):
+            if p is None:
+                cp *= table[data.columns[i].astype(np.intp)]
+            else:
+                cp *= table[data.columns[i].astype(np.intp), data.columns[p].astype(np.intp)]
+        return cp
 
     def classify(self, testf):
-        classifier = self.raw_data['attributes'][-1][0]
+        classifier = self.raw_data.attributes[-1][0]
 
-        for v in self.raw_data['attributes']:
+        for v in self.raw_data.attributes:
             if v[0] == classifier:
                 continue
-            if len(self.spanning_tree.get_vertex_by_id(v[0]).parents) == 0:
+            parentkey = self.parent_of(v[0])
+            if parentkey is None:
                 print(v[0] + " " + classifier)
             else:
-                parentkey = self.spanning_tree.get_vertex_by_id(v[0]).parents[0].id
                 print(v[0] + " " + parentkey + " " + classifier)
         print("")
 
-        with open(testf) as f:
-            self.raw_test_data = self.arff.load(f)
-        self.test_data = copy.deepcopy(self.process_raw_data(self.raw_test_data['data']))
+        self.load_test_data(testf)
 
-        p = dict()
         correct = 0
-        for v in self.raw_data['attributes'][-1][1]:
-            p[v] = self.probability(classifier, v)
-
-        for td in self.test_data:
-            cplist = dict()
-            for ckey, cval in p.iteritems():
-                cp = cval
-                for key, value in td.iteritems():
-                    if key == classifier:
-                        continue
-                    if len(self.spanning_tree.get_vertex_by_id(key).parents) == 0:
-                        cp *= self.conditional_probability(key, value, ckey, classifier)
-                    else:
-                        parentkey = self.spanning_tree.get_vertex_by_id(key).parents[0].id
-                        parentval = td[parentkey]
-                        cp *= self.conditional_probability_by2(key, value, parentkey, parentval, ckey, classifier)
-
-                cplist[ckey] = cp
-
-            tval = sum(map(lambda (x, y): y, cplist.iteritems()))
-            mval = max(cplist.iteritems(), key=operator.itemgetter(1))
-
-            if mval[0] == td[classifier]:
+        cplist = self.joint_probabilities(self.test_data)
+        classes = self.test_data.columns[-1]
+        for i in range(len(self.test_data)):
+            tval = cplist[i].sum()
+            mval = cplist[i].argmax()
+
+            if mval == classes[i]:
                 correct += 1
-            print(mval[0] + ' ' + td[classifier] + str(" %.12f" %(mval[1] / tval)).rstrip('0'))
+            print(self.test_data.value(-1, mval) + ' ' + self.test_data.value(-1, classes[i]) +
+                  str(" %.12f" %(cplist[i, mval] / tval)).rstrip('0'))
         print("\n" + str(correct))
-        return correct, len(self.raw_test_data['data'])
+        return correct, len(self.test_data)
 
-    def evaluate(self, tname):
+    def evaluate(self, tname, processes = 1):
+        """
+        :param tname: Name of the test file
+        :param processes: Number of worker processes for the runs, None for
+            one per core. The samples are drawn up front in the same order
+            as a serial evaluation, so the result does not depend on it.
+        :return: (correct, total, training size) for 4 runs per ratio
+        """
         random.seed(100)
         #ratios = [0.25, 0.5, 1]
         ratios = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
-        result = list()
+        runs = 4
 
-        self.raw_data = dict()
-        self.raw_data['attributes'] = self.eval_data['attributes']
+        samples = list()
         for r in ratios:
-            run = list()
-            for c in range(1, 5):
-                rindex = random.sample(range(0, len(self.eval_data['data'])), int(r * len(self.eval_data['data'])))
-                self.clean_training_data()
-                self.raw_data['data'] = list()
-                for i in rindex:
-                    self.raw_data['data'].append(self.eval_data['data'][i])
-                self.generate_model()
-                correct, total = self.classify(tname)
-                run.append((correct, total, int(r * len(self.eval_data['data']))))
-            result.append(run)
-        return result
+            for c in range(1, runs + 1):
+                rindex = random.sample(range(0, len(self.eval_data)), int(r * len(self.eval_data)))
+                samples.append((rindex,))
+
+        # decode the test set before the workers are forked
+        self.load_test_data(tname)
+        out = parallel.map_evaluate_runs(self, (tname,), samples, processes)
+        return [out[i:i + runs] for i in range(0, len(out), runs)]
+
+    def evaluate_run(self, tname, rindex):
+        self.clean_training_data()
+        self.raw_data = self.eval_data.take(rindex)
+        self.generate_model()
+        correct, total = self.classify(tname)
+        return correct, total, len(rindex)
 
 if __name__ == "__main__":
     t = Tan(sys.argv[1])